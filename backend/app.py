@@ -1,44 +1,93 @@
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session
+from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session, Response, stream_with_context, g, send_file
 from flask_session import Session
-import replicate
 import os
 from collections import deque
 from werkzeug.utils import secure_filename
 import zipfile
 from datetime import datetime, timezone
 import base64
-import io
+import tempfile
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import threading
 from dotenv import load_dotenv
 from functools import wraps
 from datetime import datetime
-import requests
 from celery import Celery
 import hmac
+import secrets
 import hashlib
 from flask_cors import CORS
-from models import SupabaseModels  # Import the new SupabaseModels class
+from models import SupabaseModels, SupabaseUsers  # Import the new SupabaseModels class
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity, get_jwt
 import traceback
 from datetime import timedelta
-from replicate.exceptions import ReplicateError
-from supabase import create_client, Client
+from clients import get_supabase, get_supabase_auth, get_replicate, get_lemon_squeezy, get_redis, LEMON_SQUEEZY_API_URL, REDIS_URL, initialized
+from cache import TTLCache, shared_cache, all_cache_stats
+from result_cache import result_cache, generation_key
+from ratelimit import rate_limited, check_rate_limit, acquire_inflight, release_inflight, too_many_requests, INFLIGHT_RETRY_AFTER
+from singleflight import SingleFlight
+from metrics import upstream_timer, timed_execute, observe_request, render_metrics
+from status_store import training_store, prediction_store, snapshot, TERMINAL_STATUSES
+from training_jobs import training_jobs, new_job_id, save_dataset, fetch_dataset, delete_dataset
+from dataset_store import dataset_store, dataset_manifest, dataset_hash, DATASET_HASH
+from image_mirror import schedule_mirror, read_meta, image_path, touch, IMAGE_ID, THUMBNAIL_SIZES
+import json
 
 load_dotenv()  # Make sure this is called at the beginning of your script
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}}, supports_credentials=True, allow_headers=["Content-Type", "Authorization"])
-app.secret_key = os.urandom(24)  # Set a secret key for flash messages
-app.config['SESSION_TYPE'] = 'filesystem'
+CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}}, supports_credentials=True, allow_headers=["Content-Type", "Authorization", "Last-Event-ID", "If-None-Match"], expose_headers=["ETag"])
+
+def shared_secret(name, env_var, nbytes):
+    """Secret from the env, or else one generated once and kept in redis so every worker and
+    machine signs sessions/tokens with the same key. Only falls back to a per-process random
+    key (which logs people out on restart) when redis is unreachable."""
+    value = os.getenv(env_var)
+    if value:
+        return value
+    try:
+        client = get_redis()
+        key = f"secrets:{name}"
+        client.set(key, secrets.token_hex(nbytes), nx=True)  # first one up wins
+        return client.get(key).decode('utf-8')
+    except Exception as e:
+        app.logger.warning(f"Could not load {name} from redis, using a per-process key: {str(e)}")
+        return secrets.token_hex(nbytes)
+
+app.secret_key = shared_secret("flask_secret_key", "SECRET_KEY", 24)  # Set a secret key for flash messages
+# sessions live in redis (shared by every worker/machine, expire on their own), set
+# SESSION_TYPE=filesystem for a single process dev setup
+app.config['SESSION_TYPE'] = os.getenv("SESSION_TYPE", "redis")
+if app.config['SESSION_TYPE'] == 'redis':
+    app.config['SESSION_REDIS'] = get_redis()
+    app.config['SESSION_KEY_PREFIX'] = 'session:'
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=int(os.getenv("SESSION_LIFETIME_HOURS", 24)))
 app.config['SESSION_COOKIE_SECURE'] = True  # For HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Required for cross-origin requests
 # Add this after your other configurations
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', os.urandom(32))
+app.config['JWT_SECRET_KEY'] = shared_secret("jwt_secret_key", "JWT_SECRET_KEY", 32)
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)  # Set to 1 hour, adjust as needed
 app.config['JWT_TOKEN_LOCATION'] = ['headers']
 jwt = JWTManager(app)
 Session(app)
-WEBHOOK_SECRET = "who?"
+# when set, /metrics wants "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# public url of /webhook, replicate pushes training updates here when it's set together with
+# the account's signing secret ("whsec_...", GET /v1/webhooks/default/secret)
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL")
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
+WEBHOOKS_ENABLED = bool(REPLICATE_WEBHOOK_URL and REPLICATE_WEBHOOK_SECRET)
+# older deliveries are refused, so a captured one can't be replayed later
+WEBHOOK_TOLERANCE_SECONDS = 300
+# without a webhook for this long we go back to asking replicate directly
+TRAINING_STATUS_STALE_SECONDS = int(os.getenv("TRAINING_STATUS_STALE_SECONDS", 60))
+# training progress stream (server-sent events)
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", 2))
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_STREAM_SECONDS = int(os.getenv("SSE_MAX_STREAM_SECONDS", 300))
 
 # Supabase configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -47,15 +96,20 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Supabase credentials are missing. Please check your .env file.")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Instead, we'll use Supabase for database operations
+# Instead, we'll use Supabase for database operations (shared client from clients.get_supabase)
 
 # Configure Celery
-app.config['CELERY_BROKER_URL'] = 'redis://172.20.116.49:6379/0'
-app.config['CELERY_RESULT_BACKEND'] = 'redis://172.20.116.49:6379/0'
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
+# celery doesn't connect until the first task is sent, so this costs nothing at startup
+# how long async /generate results (and who owns them) are kept
+GENERATE_JOB_TTL = 3600
+# new-style setting names only, celery refuses a config that mixes them with CELERY_*
+celery = Celery(app.name)
+celery.conf.update(
+    broker_url=os.getenv("CELERY_BROKER_URL", REDIS_URL),
+    result_backend=os.getenv("CELERY_RESULT_BACKEND", REDIS_URL),
+    task_track_started=True,  # so /generate/<job_id> can report "processing"
+    result_expires=timedelta(seconds=GENERATE_JOB_TTL)
+)
 
 # Get the Replicate API token from the environment variables
 replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
@@ -66,11 +120,71 @@ hf_token = os.getenv("HF_TOKEN")
 LEMON_SQUEEZY_API_KEY = os.getenv("LEMON_TEST_SQUEEZY_API_KEY")
 LEMON_SQUEEZY_STORE_ID = os.getenv("LEMON_SQUEEZY_STORE_ID")
 SAMPLE_PRODUCT_ID = os.getenv("SAMPLE_PRODUCT_ID")
+# every product we sell, their variants get resolved at startup and kept warm
+LEMON_SQUEEZY_PRODUCT_IDS = {pid.strip() for pid in os.getenv("LEMON_SQUEEZY_PRODUCT_IDS", "").split(",") if pid.strip()}
+if SAMPLE_PRODUCT_ID:
+    LEMON_SQUEEZY_PRODUCT_IDS.add(SAMPLE_PRODUCT_ID)
+# entries live long, the refresher keeps them current, so a slow products api never
+# shows up in /create-checkout
+VARIANT_CACHE_TTL = int(os.getenv("VARIANT_CACHE_TTL", 24 * 3600))
+VARIANT_REFRESH_INTERVAL = int(os.getenv("VARIANT_REFRESH_INTERVAL", 15 * 60))
 
 # Add these variables at the top of the file, after the imports
 CURRENT_MODEL = "Flux-Dev"
 CURRENT_LORA = "also working on this..."
 
+# resolved replicate versions, keyed by (model name, version id). A trained version never
+# changes so the ttl only bounds how long a deleted model can linger
+VERSION_CACHE_TTL = int(os.getenv("VERSION_CACHE_TTL", 3600))
+version_cache = TTLCache(
+    "replicate_versions",
+    maxsize=int(os.getenv("VERSION_CACHE_SIZE", 256)),
+    ttl=VERSION_CACHE_TTL,
+    shared=shared_cache(
+        "replicate_versions",
+        dumps=lambda version: json.dumps(version.dict(), default=str),
+        loads=lambda raw: load_version(raw)
+    )
+)
+
+# the trainer every lora is trained with, pinned. Access to it is checked once (at startup,
+# in the background) and then remembered; a "no" is only kept briefly so a fixed token is
+# picked up quickly
+TRAINER_MODEL = os.getenv("TRAINER_MODEL", "ostris/flux-dev-lora-trainer")
+TRAINER_VERSION = os.getenv("TRAINER_VERSION", "885394e6a31c6f349dd4f9e6e7ffbabd8d9840ab2559ab78aed6b2451ab2cfef")
+TRAINER_PERMISSION_TTL = int(os.getenv("TRAINER_PERMISSION_TTL", 24 * 3600))
+TRAINER_PERMISSION_NEGATIVE_TTL = int(os.getenv("TRAINER_PERMISSION_NEGATIVE_TTL", 60))
+permission_cache = TTLCache(
+    "trainer_permission",
+    maxsize=16,
+    ttl=TRAINER_PERMISSION_TTL,
+    shared=shared_cache("trainer_permission")
+)
+
+# identical concurrent replicate reads (many tabs polling one training) share one call
+replicate_flight = SingleFlight("replicate", shared=shared_cache("replicate_flight"))
+
+# /data only sends what the dashboard shows
+DATA_USER_FIELDS = os.getenv("DATA_USER_FIELDS", "id,username,email")
+DATA_MODEL_FIELDS = os.getenv("DATA_MODEL_FIELDS", "id,user_id,name,description,created_at,updated_at,model_version,status")
+data_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="data")
+
+# per user token buckets, "requests/seconds"
+RATE_LIMIT_GENERATE = os.getenv("RATE_LIMIT_GENERATE", "10/60")
+RATE_LIMIT_TRAINING = os.getenv("RATE_LIMIT_TRAINING", "3/3600")
+
+# /generate/batch limits
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", 16))
+BATCH_MAX_OUTPUTS = 4
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 4))
+# batches are charged per image on their own bucket, big enough for one full batch
+# (BATCH_MAX_JOBS x BATCH_MAX_OUTPUTS) so the largest allowed grid can always go through
+RATE_LIMIT_BATCH_IMAGES = os.getenv("RATE_LIMIT_BATCH_IMAGES", f"{BATCH_MAX_JOBS * BATCH_MAX_OUTPUTS}/600")
+
+def load_version(raw):
+    from replicate.version import Version
+    return Version(**json.loads(raw))
+
 # controlling img zip
 UPLOAD_FOLDER = 'input_images'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
@@ -81,7 +195,17 @@ NEW_MODEL_NAME = "jhonra121/ramon-lora-20240910-154729:dd117084cca97542e09f6a2a4
 
 REPLICATE_USER = "jhomra21"
 
+# training zips are streamed through a spooled temp file instead of being held in memory
+TRAINING_UPLOAD_MAX_BYTES = int(os.getenv("TRAINING_UPLOAD_MAX_BYTES", 200 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_MAX_MEMORY = 8 * 1024 * 1024  # anything bigger goes to disk
+TRAINING_RESOLUTION = "512,768,1024"
+# downscale / dedupe training images before uploading them
+PREPROCESS_TRAINING_IMAGES = os.getenv("PREPROCESS_TRAINING_IMAGES", "true").lower() == "true"
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# let werkzeug reject oversized bodies before we even start reading them
+app.config['MAX_CONTENT_LENGTH'] = TRAINING_UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -90,19 +214,109 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# get most recent predictions using replicate api, then limit to 10
-def get_recent_predictions():
-    client = replicate.Client(api_token=replicate_api_token)
-    predictions = list(client.predictions.list())[:20]  # Fetch all and slice the first 10
-    return [
-        {
-            "url": pred.output[0] if pred.output and isinstance(pred.output, list) else None,
-            "prompt": pred.input.get("prompt", "No prompt available") if pred.input else "No prompt available",
-            "status": pred.status
-        }
-        for pred in predictions
-        if pred.status == "succeeded" and pred.output
-    ]
+class UploadTooLargeError(ValueError):
+    pass
+
+def spool_upload(file_storage, max_bytes=TRAINING_UPLOAD_MAX_BYTES):
+    """Copy an uploaded file into a SpooledTemporaryFile in fixed size chunks.
+
+    Memory use stays at UPLOAD_SPOOL_MAX_MEMORY no matter how big the upload is.
+    The caller owns (and must close) the returned file, which is rewound to 0.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY, suffix='.zip')
+    total = 0
+    try:
+        while True:
+            chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadTooLargeError(f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+# supabase user ids allowed to see account wide data (the recent predictions feed, /allusers)
+ADMIN_USER_IDS = {uid.strip() for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()}
+
+def admin_required(f):
+    """Goes under @jwt_required(), 403 unless the caller is in ADMIN_USER_IDS."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method != 'OPTIONS' and get_jwt_identity() not in ADMIN_USER_IDS:
+            return jsonify({"error": "Admin access required"}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+# recent predictions feed, pages are cached briefly so repeated gallery loads are free
+RECENT_PREDICTIONS_MAX_LIMIT = 100
+recent_predictions_cache = TTLCache("recent_predictions", maxsize=64, ttl=int(os.getenv("RECENT_PREDICTIONS_TTL", 15)))
+
+def encode_feed_cursor(page_cursor, offset):
+    raw = json.dumps({"c": page_cursor, "o": offset}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_feed_cursor(cursor):
+    if not cursor:
+        return None, 0
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return data.get("c"), int(data.get("o", 0))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+def iter_predictions(client, page_cursor=None, offset=0):
+    """Lazily walk replicate's cursor pagination, one page at a time.
+
+    Yields (prediction, resume) where resume is the (page_cursor, offset) of the next
+    prediction, or None after the last one. Known without fetching the next page, so a
+    caller can stop right after any prediction.
+    """
+    while True:
+        with upstream_timer("replicate", "predictions.list"):
+            page = client.predictions.list(page_cursor) if page_cursor else client.predictions.list()
+        for index, pred in enumerate(page.results):
+            if index >= offset:
+                if index + 1 < len(page.results):
+                    resume = (page_cursor, index + 1)
+                else:
+                    resume = (page.next, 0) if page.next else None
+                yield pred, resume
+        if not page.next:
+            return
+        page_cursor, offset = page.next, 0
+
+def prediction_summary(pred):
+    url = str(pred.output[0]) if pred.output and isinstance(pred.output, list) else None
+    return {
+        "url": url,
+        # local copy + thumbnails for the gallery, replicate's url expires
+        "mirror": schedule_mirror([url], on_error=log_error)[0] if url else None,
+        "prompt": pred.input.get("prompt", "No prompt available") if pred.input else "No prompt available",
+        "status": pred.status
+    }
+
+# get most recent succeeded predictions using replicate api, stops as soon as `limit` are found
+def get_recent_predictions(limit=20, cursor=None):
+    def load():
+        client = get_replicate()
+        page_cursor, offset = decode_feed_cursor(cursor)
+        predictions = []
+        next_cursor = None
+        for pred, resume in iter_predictions(client, page_cursor, offset):
+            if pred.status == "succeeded" and pred.output:
+                predictions.append(prediction_summary(pred))
+            if len(predictions) == limit:
+                # stop right here, even if that was the last one on the page
+                next_cursor = encode_feed_cursor(*resume) if resume else None
+                break
+        return {"predictions": predictions, "next_cursor": next_cursor}
+
+    return recent_predictions_cache.get_or_load((limit, cursor), load)
 
 # simple AUTH
 def login_required(f):
@@ -113,26 +327,145 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# the prewarm threads build upstream clients, on a shared cpu that competes with the wake up
+# itself, so they start with the first request instead of at import
+_background_started = False
+_background_lock = threading.Lock()
+
+@app.before_request
+def start_background_tasks():
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if not _background_started:
+            _background_started = True
+            start_variant_refresher()
+            start_trainer_permission_check()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # label by url rule, not path, so ids don't blow up the number of series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+def verify_webhook(headers, body):
+    """Replicate signs deliveries the standard-webhooks way: base64 hmac-sha256 of
+    "<webhook-id>.<webhook-timestamp>.<body>" keyed with the base64 part of the whsec_ secret,
+    sent as space separated "v1,<signature>" entries in webhook-signature."""
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    signatures = headers.get('webhook-signature')
+    if not webhook_id or not timestamp or not signatures:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            return False
+        key = base64.b64decode(REPLICATE_WEBHOOK_SECRET.split('_', 1)[-1])
+    except ValueError:
+        return False
+    signed = f"{webhook_id}.{timestamp}.".encode('utf-8') + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode('utf-8')
+    for entry in signatures.split():
+        version, _, signature = entry.partition(',')
+        if version == 'v1' and hmac.compare_digest(signature, expected):
+            return True
+    return False
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    signature = request.headers.get('X-Replicate-Signature')
-    if not signature:
-        return jsonify({"error": "No signature provided"}), 400
-
-    expected_signature = hmac.new(
-        WEBHOOK_SECRET.encode('utf-8'),
-        request.data,
-        hashlib.sha256
-    ).hexdigest()
-
-    if not hmac.compare_digest(signature, expected_signature):
+    if not REPLICATE_WEBHOOK_SECRET:
+        return jsonify({"error": "Webhooks are not configured"}), 503
+    if not verify_webhook(request.headers, request.get_data()):
         return jsonify({"error": "Invalid signature"}), 400
 
     data = request.json
-    # Process the webhook data
-    print(f"Received valid webhook: {data}")
+    if not data or 'id' not in data:
+        return jsonify({"error": "Invalid payload"}), 400
+
+    # our own webhook urls say what they're for, otherwise trainings are the ones with a destination
+    kind = request.args.get('kind') or ('training' if 'destination' in data else 'prediction')
+    store = training_store if kind == 'training' else prediction_store
+    store.put(snapshot(data))
+    app.logger.info(f"Webhook: {kind} {data['id']} is {data.get('status')}")
     return '', 200
 
+# every user generates on the same replicate account, this feed is everyone's prompts and images
+@app.route("/recent-predictions", methods=["GET", "OPTIONS"])
+@jwt_required()
+@admin_required
+def recent_predictions():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), RECENT_PREDICTIONS_MAX_LIMIT)
+        return jsonify(get_recent_predictions(limit, request.args.get("cursor"))), 200
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid input: {str(ve)}"}), 400
+    except Exception as e:
+        app.logger.error(f"Error in recent_predictions: {str(e)}")
+        return jsonify({"error": "An error occurred while fetching predictions"}), 500
+
+# mirrored files never change (ids are hashes of the source url), let browsers / cdns keep them
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", 365 * 24 * 3600))
+
+@app.route('/images/<image_id>')
+@app.route('/images/<image_id>/<int:size>')
+def mirrored_image(image_id, size=None):
+    """A generated image (or a webp thumbnail of it) from this machine's mirror. send_file
+    takes care of ETag / If-None-Match and Range requests."""
+    if not IMAGE_ID.match(image_id) or (size is not None and size not in THUMBNAIL_SIZES):
+        return jsonify({"error": "Image not found"}), 404
+    meta = read_meta(image_id)
+    if meta is None:
+        return jsonify({"error": "Image not found"}), 404
+    if meta.get('mirrored'):
+        touch(image_id)
+        try:
+            response = send_file(
+                image_path(image_id, size),
+                mimetype='image/webp' if size else meta.get('content_type'),
+                conditional=True,
+                etag=True,
+                max_age=IMAGE_CACHE_MAX_AGE
+            )
+        except FileNotFoundError:
+            response = None  # pruned since read_meta looked
+    else:
+        response = None
+    if response is None:
+        # not on this machine (still copying, pruned, or mirrored somewhere else), start a
+        # copy here and send them to replicate meanwhile, without letting that get cached
+        schedule_mirror([meta['source']], on_error=log_error)
+        response = redirect(meta['source'])
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# readiness for fly's health checks, doesn't touch any upstream so it answers as soon
+# as the process can serve "/"
+@app.route("/ready")
+def ready():
+    return jsonify({"status": "ready", "clients": initialized()}), 200
+
 #new route ("/")
 @app.route("/")
 def index():
@@ -141,6 +474,7 @@ def index():
 # main route
 @app.route("/generate", methods=["POST", "OPTIONS"])
 @jwt_required()
+@rate_limited("generate", RATE_LIMIT_GENERATE)
 def generate_image():
     if request.method == 'OPTIONS':
         return '', 200
@@ -184,39 +518,28 @@ def generate_image():
         model_name = model['name']
         app.logger.info(f"Model name: {model_name}")
         app.logger.info(f"Model version: {model_version}")
-        version = replicate.models.get(model['name']).versions.get(model['model_version'])
-        app.logger.info(f"Version: {version}")
-        # version = f'jhomra21/{model_name}:{model_version}'
-        # Run the model
-        output = replicate.run(
-            version,
-            input={
-                "prompt": f"{prompt}; professional photo and lens",
-                "model": "dev",
-                "lora_scale": lora_scale,
-                "num_outputs": 1,
-                "aspect_ratio": "1:1",
-                "output_format": "webp",
-                "guidance_scale": guidance_scale,
-                "output_quality": 90,
-                "num_inference_steps": num_inference_steps
-            }
-        )
-        output = list(output)
 
-        image_url = output[0] if output else None
-        
-        if not image_url:
+        generation_input = build_generation_input(prompt, lora_scale, guidance_scale, num_inference_steps,
+                                                  seed=data.get("seed"))
+        use_cache = wants_result_cache(data)
+
+        if is_async_request(data):
+            # Hand the inference off to a celery worker and free this request thread right away
+            job_id = enqueue_generation(get_jwt_identity(), model_name, model_version, generation_input, use_cache)
+            return jsonify({
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": url_for('generate_status', job_id=job_id)
+            }), 202
+
+        if use_cache:
+            result = run_generation_cached(model_name, model_version, generation_input)
+        else:
+            result = run_generation(model_name, model_version, generation_input)
+        if not result["image_url"]:
             return jsonify({"error": "Failed to generate image"}), 500
-        
-        return jsonify({
-            "image_url": image_url,
-            "predict_time": None,
-            "total_time": None,
-            "guidance_scale": guidance_scale,
-            "num_inference_steps": num_inference_steps,
-            "lora_scale": lora_scale
-        })
+
+        return jsonify(result)
     except ValueError as ve:
         app.logger.error(f"ValueError in generate_image: {str(ve)}")
         return jsonify({"error": f"Invalid input: {str(ve)}"}), 400
@@ -228,81 +551,482 @@ def generate_image():
         app.logger.error(traceback.format_exc())
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
+def is_async_request(data):
+    value = data.get("async", request.args.get("async", False))
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+def build_generation_input(prompt, lora_scale, guidance_scale, num_inference_steps, num_outputs=1, seed=None):
+    generation_input = {
+        "prompt": f"{prompt}; professional photo and lens",
+        "model": "dev",
+        "lora_scale": lora_scale,
+        "num_outputs": num_outputs,
+        "aspect_ratio": "1:1",
+        "output_format": "webp",
+        "guidance_scale": guidance_scale,
+        "output_quality": 90,
+        "num_inference_steps": num_inference_steps
+    }
+    if seed is not None:
+        generation_input["seed"] = int(seed)
+    return generation_input
+
+def resolve_model_version(model_name, model_version):
+    with upstream_timer("replicate", "models.get"):
+        return get_replicate().models.get(model_name).versions.get(model_version)
+
+def get_model_version(model_name, model_version):
+    return version_cache.get_or_load(
+        (model_name, model_version),
+        lambda: resolve_model_version(model_name, model_version)
+    )
+
+def run_generation(model_name, model_version, generation_input, download_mirror=True):
+    """`download_mirror=False` only records the mirror links, for callers whose disk is never
+    served (the celery worker)."""
+    started = time.perf_counter()
+    version = get_model_version(model_name, model_version)
+    app.logger.info(f"Version: {version}")
+    # version = f'jhomra21/{model_name}:{model_version}'
+    # Run the model. Same as replicate.run, but keeping the prediction gives us its metrics
+    with upstream_timer("replicate", "run"):
+        prediction = get_replicate().predictions.create(version=version, input=generation_input)
+        prediction.wait()
+    if prediction.status != "succeeded":
+        raise RuntimeError(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+
+    output = prediction.output or []
+    if not isinstance(output, list):
+        output = [output]
+    # replicate may hand back FileOutput objects instead of plain strings
+    image_urls = [str(url) for url in output if url]
+    image_url = image_urls[0] if image_urls else None
+
+    return {
+        "image_url": image_url,
+        "image_urls": image_urls,
+        # same order as image_urls, served by /images once the background copy is done
+        "mirrors": schedule_mirror(image_urls, on_error=log_error, download=download_mirror),
+        # time on the gpu according to replicate, and what it took us end to end
+        "predict_time": (prediction.metrics or {}).get("predict_time"),
+        "total_time": round(time.perf_counter() - started, 3),
+        "guidance_scale": generation_input["guidance_scale"],
+        "num_inference_steps": generation_input["num_inference_steps"],
+        "lora_scale": generation_input["lora_scale"]
+    }
+
+def parse_sweep(data, name, default):
+    sweep = data.get("sweep") or {}
+    if not isinstance(sweep, dict):
+        raise ValueError("sweep must be an object")
+    values = sweep.get(name, [data.get(name, default)])
+    if not isinstance(values, list) or not values:
+        raise ValueError(f"sweep.{name} must be a non-empty list")
+    return values
+
+@app.route("/generate/batch", methods=["POST", "OPTIONS"])
+@jwt_required()
+def generate_batch():
+    """Generate a grid: every prompt x every lora_scale/guidance_scale/num_inference_steps in `sweep`.
+
+    The model is resolved once and predictions run concurrently (BATCH_MAX_CONCURRENCY at
+    a time). Results are streamed back as newline-delimited JSON in completion order,
+    each line carries the `index` of its job so the client can place it in the grid.
+
+    Every image counts against the per-image batch bucket (RATE_LIMIT_BATCH_IMAGES), and the
+    batch holds its share of the in-flight cap until the stream is done.
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+
+    data = request.get_json()
+    prompts = data.get("prompts")
+    model_id = data.get("model_id")
+
+    if not prompts or not isinstance(prompts, list):
+        return jsonify({"error": "Prompts must be a non-empty list"}), 400
+
+    if not model_id:
+        return jsonify({"error": "Model ID is required"}), 400
+
+    try:
+        num_outputs = int(data.get("num_outputs", 1))
+        if not 1 <= num_outputs <= BATCH_MAX_OUTPUTS:
+            raise ValueError(f"num_outputs must be between 1 and {BATCH_MAX_OUTPUTS}")
+
+        lora_scales = parse_sweep(data, "lora_scale", 0.8)
+        guidance_scales = parse_sweep(data, "guidance_scale", 3.5)
+        steps = parse_sweep(data, "num_inference_steps", 22)
+        # check the size before building anything, the product can be huge
+        job_count = len(prompts) * len(lora_scales) * len(guidance_scales) * len(steps)
+        if job_count > BATCH_MAX_JOBS:
+            return jsonify({"error": f"Batch is limited to {BATCH_MAX_JOBS} images, got {job_count}"}), 400
+
+        jobs = [
+            {"prompt": prompt, "lora_scale": lora_scale, "guidance_scale": guidance_scale,
+             "num_inference_steps": num_inference_steps}
+            for prompt in prompts
+            for lora_scale in lora_scales
+            for guidance_scale in guidance_scales
+            for num_inference_steps in steps
+        ]
+
+        model = SupabaseModels.get_model_by_id(int(model_id)).data
+        if not model:
+            return jsonify({"error": "Model not found"}), 404
+        if 'name' not in model or 'model_version' not in model:
+            return jsonify({"error": "Invalid model data"}), 500
+
+        model_name = model['name']
+        model_version = model['model_version']
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid input: {str(ve)}"}), 400
+    except Exception as e:
+        app.logger.error(f"Error in generate_batch: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+
+    limited = check_rate_limit("generate_batch", RATE_LIMIT_BATCH_IMAGES, cost=len(jobs) * num_outputs)
+    if limited is not None:
+        return limited
+    concurrency = min(BATCH_MAX_CONCURRENCY, len(jobs))
+    if not acquire_inflight(concurrency):
+        return too_many_requests("Server is busy, try again shortly", INFLIGHT_RETRY_AFTER)
+
+    try:
+        # resolve once up front so the workers all hit the cache
+        get_model_version(model_name, model_version)
+    except Exception as e:
+        release_inflight(concurrency)
+        app.logger.error(f"Error in generate_batch: {str(e)}")
+        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+
+    def run_job(job):
+        generation_input = build_generation_input(job["prompt"], job["lora_scale"], job["guidance_scale"],
+                                                  job["num_inference_steps"], num_outputs)
+        return run_generation(model_name, model_version, generation_input)
+
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = {executor.submit(run_job, job): index for index, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                index = futures[future]
+                line = {"index": index, **jobs[index]}
+                try:
+                    line.update(future.result())
+                except Exception as e:
+                    app.logger.error(f"Error in generate_batch job {index}: {str(e)}")
+                    line["error"] = str(e)
+                yield json.dumps(line) + "\n"
+        finally:
+            # client went away, don't start anything that hasn't started yet
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={"X-Batch-Size": str(len(jobs))})
+    # runs once the server is done with the stream, even if the client left before it started
+    response.call_on_close(lambda: release_inflight(concurrency))
+    return response
+
+def wants_result_cache(data):
+    # a fixed seed makes the output reproducible, so it's safe to hand back a cached one
+    value = data.get("cache", data.get("seed") is not None)
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+def run_generation_cached(model_name, model_version, generation_input, download_mirror=True):
+    """run_generation through the content-addressed result cache. Identical requests
+    running at the same time share a single prediction."""
+    def run():
+        result = run_generation(model_name, model_version, generation_input, download_mirror)
+        if not result["image_url"]:
+            raise RuntimeError("Failed to generate image")  # never cache a failure
+        return result
+
+    key = generation_key(model_name, model_version, generation_input)
+    result, cached = result_cache.get_or_run(key, run)
+    return dict(result, cached=cached)
+
+@celery.task(name="generate_image")
+def generate_image_task(user_id, model_name, model_version, generation_input, use_cache=False):
+    # the worker's disk is never served, the web machines copy the images on first request
+    if use_cache:
+        result = run_generation_cached(model_name, model_version, generation_input, download_mirror=False)
+    else:
+        result = run_generation(model_name, model_version, generation_input, download_mirror=False)
+    if not result["image_url"]:
+        raise RuntimeError("Failed to generate image")
+    result["user_id"] = user_id
+    return result
+
+def generate_job_key(job_id):
+    return f"generate_job:{job_id}"
+
+def enqueue_generation(user_id, model_name, model_version, generation_input, use_cache):
+    # owner goes in first, celery can't tell an unknown id from a queued one
+    job_id = secrets.token_hex(16)
+    get_redis().set(generate_job_key(job_id), user_id, ex=GENERATE_JOB_TTL)
+    generate_image_task.apply_async(
+        (user_id, model_name, model_version, generation_input, use_cache),
+        task_id=job_id
+    )
+    return job_id
+
+# celery states -> what the frontend already understands from replicate
+JOB_STATUSES = {
+    'PENDING': 'queued',
+    'RECEIVED': 'queued',
+    'STARTED': 'processing',
+    'RETRY': 'processing',
+    'SUCCESS': 'succeeded',
+    'FAILURE': 'failed',
+    'REVOKED': 'canceled',
+}
+
+@app.route("/generate/<job_id>", methods=["GET", "OPTIONS"])
+@jwt_required()
+def generate_status(job_id):
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    # results live in a shared backend, only the user who queued the job gets to see it
+    owner = get_redis().get(generate_job_key(job_id))
+    if owner is None or owner.decode('utf-8') != get_jwt_identity():
+        return jsonify({"error": "Job not found"}), 404
+
+    job = celery.AsyncResult(job_id)
+    state = job.state
+    response_data = {
+        "job_id": job_id,
+        "status": JOB_STATUSES.get(state, state.lower())
+    }
+
+    if state == 'SUCCESS':
+        result = dict(job.result or {})
+        result.pop("user_id", None)
+        response_data.update(result)
+    elif state == 'FAILURE':
+        response_data["error"] = str(job.result)
+
+    return jsonify(response_data), 200
+
 def get_latest_trigger_word():
     # Implement this function to retrieve the latest trigger word
     # For now, we'll return a default value
     return TRIGGER_WORD
 
-@app.route('/training_processing/<training_id>')
-@jwt_required()
-def training_processing(training_id):
-    try:
-        current_user_id = get_jwt_identity()
-        training = replicate.trainings.get(training_id)
-        
-        if training is None:
-            return jsonify({"error": "Training not found"}), 404
+# /create-training hands out job ids (uuid4 hex) before replicate has a training id
+TRAINING_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+def training_job_snapshot(job):
+    """A queued / failed pipeline job, shaped like a training snapshot."""
+    return {
+        "id": job['id'],
+        "status": job['status'],
+        "created_at": datetime.fromtimestamp(job['created_at'], timezone.utc).isoformat(),
+        "started_at": None,
+        "completed_at": None,
+        "input": {"trigger_word": job.get('trigger_word'), "steps": job.get('steps')},
+        "output": None,
+        "logs": job.get('error') or '',
+        "error": job.get('error'),
+        "urls": None,
+        "dataset_hash": job.get('dataset_hash'),
+        "handled": True  # nothing in supabase to clean up, the pipeline does that itself
+    }
 
-        elapsed_time = calculate_elapsed_time(training.created_at)
-        
-        status = training.status
-        response_data = {
-            "training_id": training.id,
-            "status": status,
-            "elapsed_time": elapsed_time,
-            "logs": training.logs,
-            "output": training.output
-        }
+def get_training_snapshot(training_id):
+    """Training state from the webhook-fed store, only asks replicate when it's missing or stale.
+    Also takes a pipeline job id and follows it to the training once one was started."""
+    if TRAINING_JOB_ID.match(training_id):
+        job = training_jobs.get(training_id)
+        if job is None:
+            return None
+        if not job.get('training_id'):
+            return training_job_snapshot(job)
+        training_id = job['training_id']
+
+    def fresh_entry():
+        entry = training_store.get(training_id)
+        return entry if training_store.is_fresh(entry, TRAINING_STATUS_STALE_SECONDS) else None
+
+    def fetch():
+        with upstream_timer("replicate", "trainings.get"):
+            training = get_replicate().trainings.get(training_id)
+        if training is None:
+            return None
+        return training_store.put(snapshot(training))
+
+    entry = fresh_entry()
+    if entry is not None:
+        return entry
+    # every tab polling this training waits on the same trainings.get
+    entry, _ = replicate_flight.do(("trainings.get", training_id), fetch, fresh_entry)
+    return entry
+
+def get_replicate_model(name):
+    def fetch():
+        with upstream_timer("replicate", "models.get"):
+            return get_replicate().models.get(name)
+    # in process only, a Model doesn't go through redis
+    model, _ = replicate_flight.do(("models.get", name), fetch)
+    return model
+
+def build_training_response(training, current_user_id):
+    """Response body for a training snapshot, runs the one-off supabase updates once it finishes."""
+    elapsed_time = calculate_elapsed_time(training['created_at'])
+    
+    status = training['status']
+    response_data = {
+        "training_id": training['id'],
+        "status": status,
+        "elapsed_time": elapsed_time,
+        "logs": training['logs'],
+        "output": training['output']
+    }
+    if training.get('dataset_hash'):
+        # send it back as datasetHash to retrain on the same images without uploading them
+        response_data["dataset_hash"] = training['dataset_hash']
 
-        if status in ['failed', 'canceled']:
-            log_training_status(training.id, status)
+    if status in ['failed', 'canceled']:
+        if not training.get('handled'):
+            log_training_status(training['id'], status)
             try:
-                trigger_word = training.input.get('trigger_word', '') if training.input else ''
-                created_at = training.created_at
-                
-                if isinstance(created_at, str):
-                    model_name = f"{trigger_word}-lora-{created_at}"
-                elif created_at:
-                    model_name = f"{trigger_word}-lora-{created_at.strftime('%Y%m%d-%H%M%S')}"
-                else:
-                    model_name = f"{trigger_word}-lora-unknown"
+                trigger_word = training['input'].get('trigger_word', '') if training['input'] else ''
+                created_at = training['created_at']
+                model_name = f"{trigger_word}-lora-{created_at}" if created_at else f"{trigger_word}-lora-unknown"
 
-                response = supabase.table('models').delete().eq('name', model_name).execute()
+                response = SupabaseModels.delete_models_by_name(model_name)
                 
                 if not response.data:
-                    log_error(f"Failed to update model status in Supabase for training: {training.id}")
+                    log_error(f"Failed to update model status in Supabase for training: {training['id']}")
             except Exception as e:
                 log_error(f"Error deleting model from Supabase: {str(e)}")
-            return jsonify(response_data)
-        
-        elif status == 'succeeded':
-            if training.output and 'version' in training.output:
-                version = training.output['version']
-                model = replicate.models.get(version)
-                latest_version = model.latest_version
-                
-                if latest_version:
-                    update_model_in_supabase(current_user_id, model.id, latest_version.id, status)
-                    response_data["model_id"] = model.id
-                    response_data["model_version"] = latest_version.id
-                    response_data["redirect"] = f"/generate/{model.id}"
-                else:
-                    log_training_status(training.id, "No version available")
-            else:
-                log_training_status(training.id, "No output or version in training")
+            training_store.update(training['id'], handled=True)
+    
+    elif status == 'succeeded':
+        if training.get('model_version'):
+            # already resolved on an earlier poll
+            response_data["model_id"] = training['model_id']
+            response_data["model_version"] = training['model_version']
+            response_data["redirect"] = f"/generate/{training['model_id']}"
+        elif training['output'] and 'version' in training['output']:
+            version = training['output']['version']
+            model = get_replicate_model(version)
+            latest_version = model.latest_version
             
-            return jsonify(response_data), 200
-        
+            if latest_version:
+                update_model_in_supabase(current_user_id, model.id, latest_version.id, status)
+                training_store.update(training['id'], model_id=model.id, model_version=latest_version.id)
+                response_data["model_id"] = model.id
+                response_data["model_version"] = latest_version.id
+                response_data["redirect"] = f"/generate/{model.id}"
+            else:
+                log_training_status(training['id'], "No version available")
         else:
-            response_data["created_at"] = training.created_at if training.created_at else ""
-            cancel_url = str(getattr(training.urls, 'cancel', None)) if status in ['starting', 'processing'] else ""
-            response_data["cancel_url"] = cancel_url
-            return jsonify(response_data)
+            log_training_status(training['id'], "No output or version in training")
+    
+    else:
+        response_data["created_at"] = training['created_at'] or ""
+        urls = training['urls'] or {}
+        cancel_url = str(urls.get('cancel')) if status in ['starting', 'processing'] else ""
+        response_data["cancel_url"] = cancel_url
+
+    return response_data
+
+@app.route('/training_processing/<training_id>')
+@jwt_required()
+def training_processing(training_id):
+    try:
+        current_user_id = get_jwt_identity()
+        training = get_training_snapshot(training_id)
+        
+        if training is None:
+            return jsonify({"error": "Training not found"}), 404
+
+        return jsonify(build_training_response(training, current_user_id)), 200
 
     except Exception as e:
         log_error(f"Error in training_processing: {str(e)}")
         return jsonify({"error": str(e), "training_id": training_id}), 500
 
+def sse_event(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data)}\n\n"
+
+# EventSource can't send an Authorization header, so the token may also come as ?jwt=
+@app.route('/training_processing/<training_id>/stream')
+@jwt_required(locations=['headers', 'query_string'])
+def training_processing_stream(training_id):
+    """Server-sent events for a training: `status` when it changes and `logs` with only
+    the new log text. Event ids are log offsets, so a reconnect with Last-Event-ID
+    (or ?offset=) picks up where the client left off instead of resending everything."""
+    current_user_id = get_jwt_identity()
+    try:
+        offset = int(request.headers.get('Last-Event-ID') or request.args.get('offset', 0))
+    except ValueError:
+        offset = 0
+
+    def generate():
+        nonlocal offset
+        last_status = None
+        started = time.monotonic()
+        last_sent = started
+
+        while True:
+            try:
+                training = get_training_snapshot(training_id)
+            except Exception as e:
+                log_error(f"Error in training_processing_stream: {str(e)}")
+                yield sse_event('error', {"error": str(e), "training_id": training_id})
+                return
+            if training is None:
+                yield sse_event('error', {"error": "Training not found", "training_id": training_id})
+                return
+
+            logs = training['logs'] or ''
+            if offset > len(logs):
+                offset = 0  # logs got shorter, e.g. a different training id, start over
+            if len(logs) > offset:
+                yield sse_event('logs', {"offset": offset, "text": logs[offset:]}, len(logs))
+                offset = len(logs)
+                last_sent = time.monotonic()
+
+            if training['status'] != last_status:
+                last_status = training['status']
+                response_data = build_training_response(training, current_user_id)
+                response_data.pop('logs', None)
+                yield sse_event('status', response_data, offset)
+                last_sent = time.monotonic()
+
+            if training['status'] in TERMINAL_STATUSES:
+                yield sse_event('done', {"status": training['status']}, offset)
+                return
+
+            now = time.monotonic()
+            if now - started > SSE_MAX_STREAM_SECONDS:
+                # let the client reconnect (it resumes from Last-Event-ID) so workers aren't held forever
+                return
+            if now - last_sent > SSE_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = now
+            time.sleep(SSE_POLL_INTERVAL)
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    }
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
 def calculate_elapsed_time(created_at):
     if not created_at:
         return "00:00:00"
@@ -313,11 +1037,13 @@ def calculate_elapsed_time(created_at):
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
 def update_model_in_supabase(user_id, model_name, model_version, status):
+    # a new version was written for this model, forget whatever we resolved before
+    version_cache.invalidate_prefix(model_name)
     try:
-        response = supabase.table('models').update({
+        response = SupabaseModels.update_model_by_name(user_id, model_name, {
             'model_version': model_version,
             'status': status
-        }).eq('user_id', user_id).eq('name', model_name).execute()
+        })
         
         if not response.data:
             log_error(f"Failed to update model in Supabase: {model_name}")
@@ -330,17 +1056,44 @@ def log_training_status(training_id, status):
 def log_error(message):
     app.logger.error(message)
 
-def check_model_permission(version_id):
+def check_model_permission(model_name=TRAINER_MODEL, version_id=TRAINER_VERSION):
+    """Can our token use this trainer version. Cached, see TRAINER_PERMISSION_TTL. Replicate
+    outages / rate limits raise instead of caching a "no", the pipeline step retries them."""
+    key = (model_name, version_id)
+    allowed = permission_cache.get(key)
+    if allowed is not None:
+        return allowed
+
+    from replicate.exceptions import ReplicateError
     try:
-        model = replicate.models.get("ostris/flux-dev-lora-trainer")
-        version = model.versions.get(version_id)
-        return True
+        with upstream_timer("replicate", "models.get"):
+            model = get_replicate().models.get(model_name)
+            model.versions.get(version_id)
     except ReplicateError as e:
+        status = getattr(e, 'status', None)
+        if status is not None and (status == 429 or status >= 500):
+            raise
         app.logger.error(f"Error checking model permission: {str(e)}")
+        permission_cache.set(key, False, TRAINER_PERMISSION_NEGATIVE_TTL)
         return False
+    permission_cache.set(key, True)
+    return True
+
+def verify_trainer_permission():
+    try:
+        if not check_model_permission():
+            log_error(f"No permission to use trainer {TRAINER_MODEL}:{TRAINER_VERSION}, trainings will fail")
+    except Exception as e:
+        log_error(f"Could not verify trainer permission at startup: {str(e)}")
+
+def start_trainer_permission_check():
+    # in the background, startup doesn't wait on replicate
+    if replicate_api_token:
+        threading.Thread(target=verify_trainer_permission, name="trainer-permission", daemon=True).start()
 
 @app.route('/create-training', methods=['POST', 'OPTIONS'])
 @jwt_required()
+@rate_limited("create_training", RATE_LIMIT_TRAINING)
 def create_training():
     if request.method == 'OPTIONS':
         return '', 200
@@ -350,87 +1103,411 @@ def create_training():
         if not current_user_id:
             return jsonify({"error": "User not authenticated"}), 401
 
-        if 'inputImages' not in request.files:
-            return jsonify({"error": "No file part"}), 400
-        
-        zip_file = request.files['inputImages']
-        
-        if not zip_file or zip_file.filename == '':
-            return jsonify({"error": "No selected file"}), 400
-        
         trigger_word = request.form.get('triggerWord')
         if not trigger_word:
             return jsonify({"error": "Trigger word is required"}), 400
         
-        # Read the zip file directly
-        zip_buffer = io.BytesIO(zip_file.read())
-        
-        # Convert zip_buffer to base64 and create a data URI
-        zip_base64 = base64.b64encode(zip_buffer.getvalue()).decode('utf-8')
-        zip_uri = f"data:application/zip;base64,{zip_base64}"
-
-        # Create a new model on Replicate
-        new_model = replicate.models.create(
-            owner=REPLICATE_USER,
-            name=f"{trigger_word}-lora-" + datetime.now().strftime("%Y%m%d-%H%M%S"),
-            visibility="private",
-            hardware="gpu-a100-large"
-        )
+        steps = int(request.form.get('steps', 800))
+        job_id = new_job_id()
+        dataset = {}
+
+        # retraining on images we already have: send the dataset_hash from an earlier training instead of the zip
+        digest = request.form.get('datasetHash')
+        if digest and 'inputImages' not in request.files:
+            if not DATASET_HASH.match(digest):
+                return jsonify({"error": "Invalid dataset hash"}), 400
+            url = dataset_store.get_url(digest, current_user_id)
+            if not url:
+                return jsonify({"error": "Dataset not found, upload the images again"}), 404
+            dataset = {"dataset_hash": digest, "input_images_url": url, "prepared": True}
+        else:
+            if 'inputImages' not in request.files:
+                return jsonify({"error": "No file part"}), 400
+            
+            zip_file = request.files['inputImages']
+            
+            if not zip_file or zip_file.filename == '':
+                return jsonify({"error": "No selected file"}), 400
 
-        # Create the training input
-        training_input = {
-            "steps": int(request.form.get('steps', 800)),
-            "lora_rank": 16,
-            "optimizer": "adamw8bit",
-            "batch_size": 1,
-            "resolution": "512,768,1024",
-            "autocaption": False,
-            "input_images": zip_uri,
-            "trigger_word": trigger_word,
-            "learning_rate": 0.0004,
-        }
+            # Stream the zip to a temp file instead of reading it all into memory
+            try:
+                zip_spool = spool_upload(zip_file)
+            except UploadTooLargeError as e:
+                return jsonify({"error": str(e)}), 413
 
-        # Check model permission
-        if not check_model_permission("885394e6a31c6f349dd4f9e6e7ffbabd8d9840ab2559ab78aed6b2451ab2cfef"):
-            return jsonify({"error": "No permission to use this model version"}), 403
+            # only persist the upload here (to storage, the worker can be on another machine),
+            # the replicate / supabase calls run in the celery chain
+            try:
+                # just reads the central directory, the images get checked by the worker
+                if not zipfile.is_zipfile(zip_spool):
+                    return jsonify({"error": "Uploaded file is not a valid zip"}), 400
+                zip_spool.seek(0)
+                save_dataset(job_id, zip_spool)
+            finally:
+                zip_spool.close()
+            dataset = {"filename": secure_filename(zip_file.filename)}
+
+        model_name = f"{trigger_word}-lora-" + datetime.now().strftime("%Y%m%d-%H%M%S")
+        try:
+            training_jobs.create(
+                job_id,
+                user_id=current_user_id,
+                trigger_word=trigger_word,
+                steps=steps,
+                model_name=model_name,
+                **dataset
+            )
+            enqueue_training_job(job_id)
+        except Exception:
+            delete_dataset(job_id)
+            raise
+
+        # the job id stands in for the training id until replicate hands us one,
+        # /training_processing/<id> accepts either
+        return jsonify({
+            "message": "Training queued...",
+            "job_id": job_id,
+            "training_id": job_id,
+            "model_name": model_name
+        }), 202
 
-        # Start the training directly
-        training = replicate.trainings.create(
-            version="ostris/flux-dev-lora-trainer:885394e6a31c6f349dd4f9e6e7ffbabd8d9840ab2559ab78aed6b2451ab2cfef",
-            input=training_input,
-            destination=REPLICATE_USER+'/'+new_model.name
+    except Exception as e:
+        app.logger.error(f"Error in create_training: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def preprocess_upload(zip_spool):
+    """Swap the raw upload for a cleaned up, downscaled zip. Closes the original."""
+    try:
+        max_side = max(int(r) for r in TRAINING_RESOLUTION.split(','))
+        # pillow + a process pool, only loaded once someone actually uploads
+        from preprocess import preprocess_training_zip
+        processed, report = preprocess_training_zip(zip_spool, ALLOWED_EXTENSIONS, max_side=max_side)
+    finally:
+        zip_spool.close()
+
+    app.logger.info(f"Preprocessed training zip: {report}")
+    if not report["images"]:
+        processed.close()
+        raise ValueError("No valid images found in the zip")
+    return processed
+
+def upload_training_zip(zip_spool, filename):
+    # Upload to replicate's file storage and hand the trainer a url instead of a data uri
+    with upstream_timer("replicate", "files.create"):
+        return get_replicate().files.create(
+            zip_spool,
+            filename=filename or "input_images.zip",
+            content_type="application/zip"
         )
 
+def file_expiry(uploaded):
+    """When replicate drops an uploaded file, as epoch seconds (None if it doesn't say)."""
+    expires_at = getattr(uploaded, 'expires_at', None)
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+    return expires_at.timestamp() if expires_at else None
+
+def training_dataset_settings():
+    # everything besides the images that changes what gets uploaded
+    return {"preprocess": PREPROCESS_TRAINING_IMAGES, "resolution": TRAINING_RESOLUTION}
+
+def reuse_stored_dataset(job_id, job):
+    """Point the job at an already uploaded copy of its dataset. False if there's none."""
+    entry = dataset_store.get(job['dataset_hash'])
+    if entry is None:
+        return False
+    # same images, so they may reference the hash themselves from now on
+    dataset_store.add_owner(job['dataset_hash'], job['user_id'])
+    training_jobs.update(job_id, prepared=True, input_images_url=entry['url'])
+    delete_dataset(job_id)
+    log_training_status(job_id, f"reusing dataset {job['dataset_hash']}")
+    return True
+
+# -------- training pipeline --------
+# /create-training -> prepare dataset -> upload it -> create the replicate model -> insert the
+# supabase row -> start the training. Every step checks the job record first and skips work
+# that's already done, so a retried or redelivered task never creates anything twice.
+# Where a lost response leaves us unsure (trainings.create), the step records the attempt
+# first and looks the result up on replicate before trying again.
+TRAINING_TASK_MAX_RETRIES = int(os.getenv("TRAINING_TASK_MAX_RETRIES", 5))
+
+class TrainingJobError(Exception):
+    """A step that won't succeed by retrying (bad upload, no permission). Fails the job right away."""
+    pass
+
+class TrainingStep(celery.Task):
+    # redelivered if the worker dies mid step, the steps are idempotent
+    acks_late = True
+    autoretry_for = (Exception,)
+    dont_autoretry_for = (TrainingJobError,)
+    max_retries = TRAINING_TASK_MAX_RETRIES
+    retry_backoff = 5
+    retry_backoff_max = 300
+    retry_jitter = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        # only called once the retries are used up (or for a TrainingJobError)
+        fail_training_job(args[0], f"{self.name}: {exc}")
+
+def enqueue_training_job(job_id):
+    from celery import chain
+    chain(
+        prepare_training_dataset.si(job_id),
+        upload_training_dataset.si(job_id),
+        create_training_model.si(job_id),
+        record_training_model.si(job_id),
+        start_training_job.si(job_id)
+    ).apply_async()
+
+def fail_training_job(job_id, error):
+    log_error(f"Training job {job_id} failed: {error}")
+    job = training_jobs.update(job_id, status='failed', error=error)
+    delete_dataset(job_id)
+    if job.get('training_id'):
+        return
+    # nothing is training, don't leave a model row or an empty replicate model behind
+    full_name = f"{REPLICATE_USER}/{job['model_name']}"
+    if job.get('model_recorded'):
+        try:
+            SupabaseModels.delete_models_by_name(full_name)
+        except Exception as e:
+            log_error(f"Error deleting model {full_name} from Supabase: {str(e)}")
+    if job.get('model_created'):
+        try:
+            with upstream_timer("replicate", "models.delete"):
+                get_replicate().models.delete(full_name)
+        except Exception as e:
+            log_error(f"Error deleting replicate model {full_name}: {str(e)}")
+
+@celery.task(name="training.prepare_dataset", base=TrainingStep)
+def prepare_training_dataset(job_id):
+    job = training_jobs.get(job_id)
+    if job.get('prepared'):
+        return
+    path = fetch_dataset(job_id, 'raw')
+
+    if not job.get('dataset_hash'):
+        # hashing is cheap next to decoding / resizing, and a hit skips both plus the upload
+        try:
+            with open(path, 'rb') as raw:
+                manifest = dataset_manifest(raw, ALLOWED_EXTENSIONS)
+        except zipfile.BadZipFile as e:
+            raise TrainingJobError(str(e))
+        if not any(item['name'].rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS for item in manifest):
+            raise TrainingJobError("No valid images found in the zip")
+        job = training_jobs.update(job_id, dataset_hash=dataset_hash(manifest, training_dataset_settings()),
+                                   manifest=manifest)
+    if reuse_stored_dataset(job_id, job):
+        return
+
+    if PREPROCESS_TRAINING_IMAGES:
+        try:
+            processed = preprocess_upload(open(path, 'rb'))
+        except (zipfile.BadZipFile, ValueError) as e:
+            raise TrainingJobError(str(e))
+        try:
+            save_dataset(job_id, processed, version='processed')
+        finally:
+            processed.close()
+        training_jobs.update(job_id, prepared=True, dataset_version='processed')
+    else:
+        training_jobs.update(job_id, prepared=True)
+
+@celery.task(name="training.upload_dataset", base=TrainingStep)
+def upload_training_dataset(job_id):
+    job = training_jobs.get(job_id)
+    if job.get('input_images_url'):
+        return
+    # another job may have uploaded the same images in the meantime
+    if reuse_stored_dataset(job_id, job):
+        return
+    with open(fetch_dataset(job_id, job.get('dataset_version', 'raw')), 'rb') as dataset:
+        uploaded = upload_training_zip(dataset, job['filename'])
+    url = uploaded.urls['get']
+    dataset_store.put(job['dataset_hash'], url, job['manifest'], job['user_id'], expires_at=file_expiry(uploaded))
+    training_jobs.update(job_id, input_images_url=url, manifest=None)
+
+@celery.task(name="training.create_model", base=TrainingStep)
+def create_training_model(job_id):
+    from replicate.exceptions import ReplicateError
+    job = training_jobs.get(job_id)
+    if job.get('model_created'):
+        return
+    # check before creating anything, a missing permission would leave an unused model behind
+    if not check_model_permission():
+        raise TrainingJobError("No permission to use this model version")
+    try:
+        with upstream_timer("replicate", "models.create"):
+            get_replicate().models.create(
+                owner=REPLICATE_USER,
+                name=job['model_name'],
+                visibility="private",
+                hardware="gpu-a100-large"
+            )
+    except ReplicateError as e:
+        # an earlier attempt created it but died before saving that
+        if getattr(e, 'status', None) != 409:
+            raise
+    training_jobs.update(job_id, model_created=True)
+
+@celery.task(name="training.record_model", base=TrainingStep)
+def record_training_model(job_id):
+    job = training_jobs.get(job_id)
+    if job.get('model_recorded'):
+        return
+    full_name = f"{REPLICATE_USER}/{job['model_name']}"
+    # straight from supabase, a cached empty answer from before a lost insert response
+    # would insert the row twice
+    existing = SupabaseModels.get_models_by_name(job['user_id'], full_name, fresh=True)
+    if not existing.data:
         # Store the training information in the database
         SupabaseModels.insert_model(
-            user_id=current_user_id,
-            name=REPLICATE_USER+'/'+new_model.name,
-            description=f"Training for {trigger_word}",
+            user_id=job['user_id'],
+            name=full_name,
+            description=f"Training for {job['trigger_word']}",
             model_version='',  # This will be updated when training is complete
             status="pending"
         )
+    training_jobs.update(job_id, model_recorded=True)
+
+# how far back find_started_training looks, trainings.list is newest first
+TRAINING_LOOKUP_MAX_PAGES = 5
+TRAINING_LOOKUP_SLACK_SECONDS = 300
+
+def find_started_training(destination, requested_at):
+    """The training an earlier attempt created for `destination`, if it got to replicate.
+    Stops at trainings created well before that attempt."""
+    client = get_replicate()
+    cursor = None
+    for _ in range(TRAINING_LOOKUP_MAX_PAGES):
+        with upstream_timer("replicate", "trainings.list"):
+            page = client.trainings.list(cursor) if cursor else client.trainings.list()
+        for training in page.results:
+            if training.destination == destination:
+                return training
+            try:
+                created_at = datetime.fromisoformat(training.created_at.replace('Z', '+00:00')).timestamp()
+            except (AttributeError, TypeError, ValueError):
+                continue
+            if created_at < requested_at - TRAINING_LOOKUP_SLACK_SECONDS:
+                return None
+        if not page.next:
+            return None
+        cursor = page.next
+    # couldn't rule it out, better a failed job than a second a100 training
+    raise TrainingJobError(f"Could not tell whether a training for {destination} was already started")
+
+@celery.task(name="training.start", base=TrainingStep)
+def start_training_job(job_id):
+    job = training_jobs.get(job_id)
+    if job.get('training_id'):
+        return job['training_id']
+    destination = f"{REPLICATE_USER}/{job['model_name']}"
+    # a timeout, a crash or a redelivery after trainings.create reached replicate must not
+    # start a second training, so the attempt is recorded first and looked up on the next try
+    if job.get('training_requested_at'):
+        training = find_started_training(destination, job['training_requested_at'])
+        if training is not None:
+            return record_started_training(job_id, job, training)
+    else:
+        job = training_jobs.update(job_id, training_requested_at=time.time())
+
+    # Create the training input
+    training_input = {
+        "steps": job['steps'],
+        "lora_rank": 16,
+        "optimizer": "adamw8bit",
+        "batch_size": 1,
+        "resolution": TRAINING_RESOLUTION,
+        "autocaption": False,
+        "input_images": job['input_images_url'],
+        "trigger_word": job['trigger_word'],
+        "learning_rate": 0.0004,
+    }
 
-        return jsonify({
-            "message": "Training started...",
-            "training_id": training.id,
-            "model_name": new_model.name
-        }), 202
+    webhook_params = {}
+    if WEBHOOKS_ENABLED:
+        webhook_params = {
+            "webhook": f"{REPLICATE_WEBHOOK_URL}?kind=training",
+            "webhook_events_filter": ["start", "logs", "completed"]
+        }
+    with upstream_timer("replicate", "trainings.create"):
+        training = get_replicate().trainings.create(
+            version=f"{TRAINER_MODEL}:{TRAINER_VERSION}",
+            input=training_input,
+            destination=destination,
+            **webhook_params
+        )
+    return record_started_training(job_id, job, training)
 
-    except Exception as e:
-        app.logger.error(f"Error in create_training: {str(e)}")
-        app.logger.error(traceback.format_exc())
-        return jsonify({"status": "error", "message": str(e)}), 500
+def record_started_training(job_id, job, training):
+    training_store.put(snapshot(training), dataset_hash=job.get('dataset_hash'))
+    training_jobs.update(job_id, status='started', training_id=training.id)
+    # replicate has its own copy now
+    delete_dataset(job_id)
+    log_training_status(training.id, "started")
+    return training.id
 
 # -------- user stuff --------
+ALLUSERS_DEFAULT_LIMIT = 100
+ALLUSERS_MAX_LIMIT = 1000
+FIELD_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+def parse_user_fields(fields):
+    """`fields` query param -> postgrest select string. `id` is always included, we page on it."""
+    if not fields:
+        return '*'
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    for name in names:
+        if not FIELD_NAME.match(name):
+            raise ValueError(f"Invalid field: {name}")
+    if 'id' not in names:
+        names.insert(0, 'id')
+    return ','.join(names)
+
+def fetch_users_page(fields, limit, after=None):
+    # keyset pagination on id, postgrest only ever reads `limit` rows
+    query = get_supabase().table('users').select(fields).order('id').limit(limit)
+    if after:
+        query = query.gt('id', after)
+    return timed_execute(query, 'users.page').data or []
+
+# every account (emails too, by default), same as the predictions feed it's admins only
 @app.route('/allusers')
 @jwt_required()
+@admin_required
 def all_users():
+    """Users, one page at a time: ?limit=&after=<last id>&fields=id,username.
+
+    ?format=ndjson streams every page as newline-delimited JSON instead, for exports.
+    """
     try:
-        response = supabase.table('users').select('*').execute()
-        users = response.data
+        fields = parse_user_fields(request.args.get('fields'))
+        limit = min(max(int(request.args.get('limit', ALLUSERS_DEFAULT_LIMIT)), 1), ALLUSERS_MAX_LIMIT)
+        after = request.args.get('after')
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid input: {str(ve)}"}), 400
+
+    try:
+        if request.args.get('format') == 'ndjson':
+            def export():
+                cursor = after
+                while True:
+                    users = fetch_users_page(fields, limit, cursor)
+                    for user in users:
+                        yield json.dumps(user, default=str) + "\n"
+                    if len(users) < limit:
+                        return
+                    cursor = users[-1]['id']
+
+            return Response(stream_with_context(export()), mimetype='application/x-ndjson')
+
+        users = fetch_users_page(fields, limit, after)
         current_user_id = get_jwt_identity()
         return jsonify({
             'users': users,
+            'next_after': users[-1]['id'] if len(users) == limit else None,
             'is_logged_in': True,
             'user_id': current_user_id
         })
@@ -448,8 +1525,8 @@ def verify_token():
     
     current_user_id = get_jwt_identity()
     try:
-        response = supabase.table('users').select('id', 'username').eq('id', current_user_id).single().execute()
-        user = response.data
+        # called on every navigation, the profile almost always comes from the cache
+        user = SupabaseUsers.get_profile(current_user_id, get_jwt().get('exp'))
         if user:
             return jsonify({
                 "id": user['id'],
@@ -477,7 +1554,8 @@ def login():
 
     try:
         # Attempt to sign in with Supabase
-        response = supabase.auth.sign_in_with_password({"email": email, "password": password})
+        with upstream_timer("supabase", "auth.sign_in"):
+            response = get_supabase_auth().auth.sign_in_with_password({"email": email, "password": password})
         
         # Check if the sign-in was successful
         if response.user and response.session:
@@ -520,20 +1598,12 @@ def signup():
     
     try:
         # Check if user already exists
-        existing_user = supabase.table('users').select('*').eq('email', email).execute()
+        existing_user = timed_execute(get_supabase().table('users').select('*').eq('email', email), 'users.get_by_email')
         if existing_user.data:
             return jsonify({'error': 'Email already registered.'}), 400
 
         # Create new user
-        user = supabase.auth.sign_up({
-            "email": email,
-            "password": password,
-            "options": {
-                "data": {
-                    "username": username
-                }
-            }
-        })
+        user = SupabaseUsers.sign_up_user(email, password, username)
         
         if user.user:
             # Create a JWT token
@@ -556,19 +1626,18 @@ def signup():
 
 # lemon squeezy sample product
 def get_variant_id(product_id):
-    headers = {
-        'Accept': 'application/vnd.api+json',
-        'Authorization': f'Bearer {LEMON_SQUEEZY_API_KEY}'
-    }
+    lemon_squeezy = get_lemon_squeezy()
     try:
-        product_response = requests.get(f'https://api.lemonsqueezy.com/v1/products/{product_id}', headers=headers)
+        with upstream_timer("lemon_squeezy", "products.get"):
+            product_response = lemon_squeezy.get(f'{LEMON_SQUEEZY_API_URL}/v1/products/{product_id}')
         product_data = product_response.json()
         
         if 'data' in product_data and 'relationships' in product_data['data']:
             variants_url = product_data['data']['relationships']['variants']['links']['related']
             
             # Now, fetch the variants
-            variants_response = requests.get(variants_url, headers=headers)
+            with upstream_timer("lemon_squeezy", "variants.get"):
+                variants_response = lemon_squeezy.get(variants_url)
             variants_data = variants_response.json()
             
             if 'data' in variants_data and variants_data['data']:
@@ -580,6 +1649,36 @@ def get_variant_id(product_id):
         print(f"Error in get_variant_id: {str(e)}")
     return None
 
+variant_cache = TTLCache("lemon_variants", maxsize=64, ttl=VARIANT_CACHE_TTL)
+
+def resolve_variant_id(product_id):
+    variant_id = variant_cache.get(product_id)
+    if variant_id is None:
+        variant_id = get_variant_id(product_id)
+        if variant_id:  # failures aren't cached, next click tries again
+            variant_cache.set(product_id, variant_id)
+    return variant_id
+
+def refresh_variants():
+    for product_id in list(LEMON_SQUEEZY_PRODUCT_IDS):
+        variant_id = get_variant_id(product_id)
+        # keep serving the old id if lemon squeezy is having a bad moment
+        if variant_id:
+            variant_cache.set(product_id, variant_id)
+
+def variant_refresher():
+    while True:
+        try:
+            refresh_variants()
+        except Exception as e:
+            log_error(f"Error refreshing lemon squeezy variants: {str(e)}")
+        time.sleep(VARIANT_REFRESH_INTERVAL)
+
+def start_variant_refresher():
+    # first pass is the prewarm, done in the background so startup doesn't wait on lemon squeezy
+    if LEMON_SQUEEZY_PRODUCT_IDS and LEMON_SQUEEZY_API_KEY:
+        threading.Thread(target=variant_refresher, name="variant-refresher", daemon=True).start()
+
 
 @app.route('/create-checkout', methods=['POST', 'OPTIONS'])
 @jwt_required()
@@ -587,18 +1686,20 @@ def create_checkout():
     if request.method == 'OPTIONS':
         return '', 200
     
+    # auth / accept headers are set on the shared session
     headers = {
-        'Accept': 'application/vnd.api+json',
-        'Content-Type': 'application/vnd.api+json',
-        'Authorization': f'Bearer {LEMON_SQUEEZY_API_KEY}'
+        'Content-Type': 'application/vnd.api+json'
     }
     
     store_id = LEMON_SQUEEZY_STORE_ID
-    product_id = SAMPLE_PRODUCT_ID  # This should be the actual product ID
+    data = request.get_json(silent=True) or {}
+    product_id = str(data.get('product_id') or SAMPLE_PRODUCT_ID)
+    if product_id not in LEMON_SQUEEZY_PRODUCT_IDS:
+        return jsonify({'error': 'Unknown product'}), 400
     print(f"Store ID: {store_id}")
     print(f"Product ID: {product_id}")
 
-    variant_id = get_variant_id(product_id)
+    variant_id = resolve_variant_id(product_id)
     print(f"Variant ID: {variant_id}")
 
     if not store_id or not variant_id:
@@ -625,8 +1726,9 @@ def create_checkout():
     }
 }
     
-    response = requests.post('https://api.lemonsqueezy.com/v1/checkouts', 
-                             json=payload, headers=headers)
+    with upstream_timer("lemon_squeezy", "checkouts.create"):
+        response = get_lemon_squeezy().post(f'{LEMON_SQUEEZY_API_URL}/v1/checkouts', 
+                                            json=payload, headers=headers)
     print(f"Checkout Status Code: {response.status_code}")
     print(f"Checkout Response: {response.text}")
 
@@ -648,21 +1750,36 @@ def get_data():
         # Get the user ID from the JWT token
         current_user_id = get_jwt_identity()
 
-        # Fetch user data
-        user_response = supabase.table('users').select('*').eq('id', current_user_id).single().execute()
-        user_data = user_response.data
+        # Fetch user and models at the same time, models usually come from the SupabaseModels cache
+        user_future = data_executor.submit(SupabaseUsers.get_profile, current_user_id, get_jwt().get('exp'),
+                                          ",".join(field.strip() for field in DATA_USER_FIELDS.split(',')))
+        models_future = data_executor.submit(SupabaseModels.get_models_by_user_id, current_user_id)
 
-        if not user_data:
+        profile = user_future.result()
+
+        if not profile:
             return jsonify({"error": "User not found"}), 404
+
+        user_data = {field.strip(): profile.get(field.strip()) for field in DATA_USER_FIELDS.split(',')}
         
-        # Fetch models data
-        models_response = supabase.table('models').select('*').eq('user_id', current_user_id).execute()
-        models_data = models_response.data
+        model_fields = [field.strip() for field in DATA_MODEL_FIELDS.split(',')]
+        models_data = [
+            {field: model.get(field) for field in model_fields}
+            for model in models_future.result().data or []
+        ]
 
-        return jsonify({
+        payload = {
             "user": user_data,
             "models": models_data
-        })
+        }
+        response = jsonify(payload)
+        # the tag covers every row's updated_at but also catches deletes and rows
+        # without an updated_at trigger, so hash the whole (small) payload
+        latest_update = max((m.get('updated_at') or '' for m in models_data), default='')
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+        response.set_etag(f"{latest_update}-{len(models_data)}-{digest}".replace(' ', '_'))
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
 
     except Exception as e:
         app.logger.error(f"Error in get_data: {str(e)}")
@@ -681,6 +1798,10 @@ def logout():
 def not_found(error):
     return jsonify({"error": "Not found"}), 404
 
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({"error": f"Upload exceeds the {TRAINING_UPLOAD_MAX_BYTES // (1024 * 1024)} MB limit"}), 413
+
 @app.errorhandler(500)
 def server_error(error):
     return jsonify({"error": "Internal server error"}), 500
@@ -692,6 +1813,11 @@ def handle_exception(e):
     # Return JSON instead of HTML for HTTP errors
     return jsonify({"error": "An unexpected error occurred"}), 500
 
+@app.route('/cache-stats', methods=['GET'])
+@jwt_required()
+def cache_stats():
+    return jsonify({"caches": all_cache_stats()}), 200
+
 @app.route('/debug-token', methods=['GET', 'OPTIONS'])
 @jwt_required()
 def debug_token():
@@ -700,5 +1826,6 @@ def debug_token():
     current_token = get_jwt()
     return jsonify(current_token), 200
 
+
 if __name__ == "__main__":
     app.run(debug=True)
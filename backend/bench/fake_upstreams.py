@@ -0,0 +1,453 @@
+"""Local stand-ins for Replicate, Supabase (PostgREST, auth and storage) and Lemon Squeezy.
+
+Only the endpoints app.py actually uses are implemented, with just enough of the
+real response shape for the client libraries to parse them. Every upstream gets its
+own latency distribution and error rate so a benchmark can model a slow or flaky one:
+
+    python -m bench.fake_upstreams --replicate-latency lognormal:300:0.5 --supabase-errors 0.01
+"""
+import argparse
+import email.parser
+import email.policy
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TRAINER_VERSION = "885394e6a31c6f349dd4f9e6e7ffbabd8d9840ab2559ab78aed6b2451ab2cfef"
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class Latency:
+    """Parsed from "fixed:50", "uniform:20:80" or "lognormal:<median ms>:<sigma>"."""
+
+    def __init__(self, spec="fixed:0"):
+        self.spec = spec
+        kind, *params = spec.split(':')
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self):
+        """Seconds."""
+        if self.kind == 'fixed':
+            ms = self.params[0]
+        elif self.kind == 'uniform':
+            ms = random.uniform(self.params[0], self.params[1])
+        else:
+            ms = random.lognormvariate(math.log(max(self.params[0], 0.001)), self.params[1])
+        return ms / 1000.0
+
+
+class Upstream:
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real apis
+    upstream = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, status, data, content_type='application/json'):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_any(self, method):
+        url = urlparse(self.path)
+        body = self.read_body()
+        upstream = self.upstream
+        with upstream.lock:
+            upstream.requests += 1
+        time.sleep(upstream.latency.sample())
+        if random.random() < upstream.error_rate:
+            with upstream.lock:
+                upstream.errors += 1
+            return self.send_json(503, {"error": "injected failure"})
+        try:
+            status, data = self.route(method, url.path, parse_qs(url.query), body)
+        except KeyError:
+            status, data = 404, {"detail": "Not found"}
+        if isinstance(data, tuple):
+            data, content_type = data
+            return self.send_json(status, data, content_type)
+        return self.send_json(status, data)
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PATCH(self):
+        self.handle_any('PATCH')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+class FakeReplicate(FakeHandler):
+    """/v1/models, /v1/predictions, /v1/trainings and /v1/files."""
+    prediction_latency = Latency("fixed:0")
+    lock = threading.Lock()
+    predictions = {}
+    trainings = {}
+    training_log_lines = 200
+    _output_image = None
+
+    @staticmethod
+    def model(owner, name):
+        return {
+            "url": f"https://replicate.com/{owner}/{name}", "owner": owner, "name": name,
+            "description": None, "visibility": "private", "github_url": None, "paper_url": None,
+            "license_url": None, "run_count": 0, "cover_image_url": None, "default_example": None,
+            "latest_version": FakeReplicate.version(f"{name}-v1"),
+        }
+
+    @staticmethod
+    def version(version_id):
+        return {"id": version_id, "created_at": now_iso(), "cog_version": "0.9.0", "openapi_schema": {}}
+
+    @classmethod
+    def advance(cls, obj):
+        """Predictions/trainings finish after their sampled duration."""
+        elapsed = time.time() - obj['_created']
+        if obj['status'] in ('succeeded', 'failed', 'canceled'):
+            return obj
+        if elapsed >= obj['_duration']:
+            obj['status'] = 'succeeded'
+            obj['completed_at'] = now_iso()
+            obj['metrics'] = {"predict_time": round(obj['_duration'], 3)}
+            obj['output'] = obj['_output']
+        elif elapsed > 0:
+            obj['status'] = 'processing'
+            obj['started_at'] = obj['started_at'] or now_iso()
+        lines = int(cls.training_log_lines * min(1.0, elapsed / max(obj['_duration'], 0.001)))
+        obj['logs'] = "".join(f"step {i}: loss=0.{i:04d}\n" for i in range(lines))
+        return obj
+
+    @staticmethod
+    def public(obj):
+        return {k: v for k, v in obj.items() if not k.startswith('_')}
+
+    def new_job(self, version, data, output, extra=None):
+        job_id = uuid.uuid4().hex[:20]
+        job = {
+            "id": job_id, "model": version.split(':')[0], "version": version.split(':')[-1],
+            "status": "starting", "input": data.get('input', {}), "output": None, "logs": "",
+            "error": None, "metrics": {}, "created_at": now_iso(), "started_at": None,
+            "completed_at": None, "urls": {
+                "get": f"http://{self.headers.get('Host')}/v1/predictions/{job_id}",
+                "cancel": f"http://{self.headers.get('Host')}/v1/predictions/{job_id}/cancel",
+            },
+            "_created": time.time(), "_duration": self.prediction_latency.sample(), "_output": output,
+        }
+        job.update(extra or {})
+        return job
+
+    @classmethod
+    def output_image(cls):
+        if cls._output_image is None:
+            from PIL import Image
+            out = io.BytesIO()
+            Image.new('RGB', (1024, 1024), (90, 120, 200)).save(out, format='WEBP')
+            cls._output_image = out.getvalue()
+        return cls._output_image
+
+    def route(self, method, path, query, body):
+        if path.startswith('/delivery/') and method == 'GET':
+            return 200, (self.output_image(), 'image/webp')
+        data = json.loads(body) if body and body[:1] == b'{' else {}
+        parts = [p for p in path.split('/') if p][1:]  # drop "v1"
+
+        if parts[:1] == ['models']:
+            if method == 'POST' and len(parts) == 1:
+                return 201, self.model(data['owner'], data['name'])
+            if len(parts) == 3 and method == 'GET':
+                return 200, self.model(parts[1], parts[2])
+            if len(parts) == 5 and parts[3] == 'versions':
+                return 200, self.version(parts[4])
+            if len(parts) == 6 and parts[5] == 'trainings' and method == 'POST':
+                destination = data.get('destination', 'bench/model')
+                job = self.new_job(f"{parts[1]}/{parts[2]}:{parts[4]}", data,
+                                   {"version": f"{destination}:{uuid.uuid4().hex}", "weights": "https://example.invalid/w.tar"},
+                                   {"destination": destination})
+                job['_duration'] *= 10  # trainings are a lot slower than predictions
+                with self.lock:
+                    self.trainings[job['id']] = job
+                return 201, self.public(job)
+
+        if parts[:1] == ['predictions']:
+            if method == 'POST' and len(parts) == 1:
+                num_outputs = int(data.get('input', {}).get('num_outputs', 1))
+                # served by this fake (see /delivery), so nothing that follows an output url leaves the machine
+                output = [f"http://{self.headers.get('Host')}/delivery/{uuid.uuid4().hex}.webp" for _ in range(num_outputs)]
+                job = self.new_job(data.get('version', 'bench/model:v1'), data, output)
+                with self.lock:
+                    self.predictions[job['id']] = job
+                return 201, self.public(job)
+            if method == 'GET' and len(parts) == 1:
+                with self.lock:
+                    jobs = [self.public(self.advance(p)) for p in self.predictions.values()]
+                jobs.reverse()
+                page_size = 100
+                offset = int(query.get('cursor', ['0'])[0])
+                next_url = None
+                if offset + page_size < len(jobs):
+                    next_url = f"http://{self.headers.get('Host')}/v1/predictions?cursor={offset + page_size}"
+                return 200, {"results": jobs[offset:offset + page_size], "next": next_url, "previous": None}
+            with self.lock:
+                job = self.advance(self.predictions[parts[1]])
+            return 200, self.public(job)
+
+        if parts[:1] == ['trainings'] and len(parts) == 2:
+            with self.lock:
+                job = self.advance(self.trainings[parts[1]])
+            return 200, self.public(job)
+
+        if parts[:1] == ['files'] and method == 'POST':
+            file_id = uuid.uuid4().hex
+            return 201, {
+                "id": file_id, "name": "input_images.zip", "content_type": "application/zip",
+                "size": len(body), "etag": file_id, "checksums": {}, "metadata": {},
+                "created_at": now_iso(), "expires_at": None,
+                "urls": {"get": f"https://api.replicate.com/v1/files/{file_id}"},
+            }
+        raise KeyError(path)
+
+
+class FakeSupabase(FakeHandler):
+    """Enough PostgREST (eq/gt filters, select, order, limit, single), gotrue and storage
+    (upload, signed download, remove) for app.py."""
+    lock = threading.Lock()
+    tables = {"users": [], "models": []}
+    objects = {}
+
+    @classmethod
+    def seed(cls, users=100, models_per_user=5):
+        cls.tables = {"users": [], "models": []}
+        model_id = 1
+        for i in range(users):
+            user_id = str(uuid.UUID(int=i + 1))
+            cls.tables["users"].append({
+                "id": user_id, "username": f"user{i}", "email": f"user{i}@bench.local",
+                "created_at": now_iso(), "updated_at": now_iso(),
+            })
+            for j in range(models_per_user):
+                cls.tables["models"].append({
+                    "id": model_id, "user_id": user_id, "name": f"bench/user{i}-lora-{j}",
+                    "description": f"Training for user{i}", "model_version": f"v{model_id}",
+                    "status": "succeeded", "created_at": now_iso(), "updated_at": now_iso(),
+                })
+                model_id += 1
+
+    @staticmethod
+    def matches(row, query):
+        for column, values in query.items():
+            if column in ('select', 'order', 'limit', 'offset', 'columns'):
+                continue
+            op, _, value = values[0].partition('.')
+            current = row.get(column)
+            if op == 'eq' and str(current) != value:
+                return False
+            if op == 'gt' and not (current is not None and str(current) > value):
+                return False
+        return True
+
+    @staticmethod
+    def project(row, select):
+        if not select or select == '*':
+            return dict(row)
+        columns = [c.strip() for c in re.split(r',(?![^(]*\))', select)]
+        return {c: row.get(c) for c in columns if '(' not in c}
+
+    def multipart_file(self, body):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + body)
+        for part in message.iter_parts():
+            if part.get_param('name', header='content-disposition') == 'file':
+                return part.get_payload(decode=True)
+        raise KeyError('file')
+
+    def storage(self, method, parts, body):
+        """/storage/v1/object/<bucket>/<path>, /object/sign/<bucket>/<path> and DELETE /object/<bucket>."""
+        if parts[:1] == ['sign']:
+            key = '/'.join(parts[1:])
+            if key not in self.objects:
+                return 400, {"statusCode": "404", "error": "not_found", "message": "Object not found"}
+            if method == 'POST':
+                return 200, {"signedURL": f"/object/sign/{key}?token=bench"}
+            return 200, (self.objects[key], 'application/octet-stream')
+        if method == 'POST':
+            key = '/'.join(parts)
+            with self.lock:
+                self.objects[key] = self.multipart_file(body)
+            return 200, {"Key": key, "Id": uuid.uuid4().hex}
+        if method == 'DELETE' and len(parts) == 1:
+            with self.lock:
+                removed = [self.objects.pop(f"{parts[0]}/{prefix}", None) for prefix in json.loads(body)['prefixes']]
+            return 200, [{"name": prefix} for prefix, data in zip(json.loads(body)['prefixes'], removed) if data]
+        raise KeyError('/'.join(parts))
+
+    def route(self, method, path, query, body):
+        if path.startswith('/storage/v1/object/'):
+            return self.storage(method, [p for p in path.split('/') if p][3:], body)
+        if path.startswith('/auth/v1/'):
+            user = {"id": str(uuid.UUID(int=1)), "aud": "authenticated", "role": "authenticated",
+                    "email": "user0@bench.local", "app_metadata": {}, "user_metadata": {},
+                    "created_at": now_iso()}
+            if path.endswith('/signup'):
+                return 200, user
+            return 200, {"access_token": "bench", "token_type": "bearer", "expires_in": 3600,
+                         "expires_at": int(time.time()) + 3600, "refresh_token": "bench", "user": user}
+
+        table = path.rsplit('/', 1)[-1]
+        select = query.get('select', ['*'])[0]
+        single = 'vnd.pgrst.object' in (self.headers.get('Accept') or '')
+        with self.lock:
+            rows = self.tables[table]
+            if method == 'POST':
+                data = json.loads(body)
+                data.setdefault('id', len(rows) + 1)
+                data.setdefault('updated_at', now_iso())
+                rows.append(data)
+                matched = [data]
+            else:
+                matched = [row for row in rows if self.matches(row, query)]
+                if method == 'PATCH':
+                    for row in matched:
+                        row.update(json.loads(body), updated_at=now_iso())
+                elif method == 'DELETE':
+                    self.tables[table] = [row for row in rows if row not in matched]
+            if 'order' in query:
+                column = query['order'][0].split('.')[0]
+                matched = sorted(matched, key=lambda row: str(row.get(column)))
+            if 'limit' in query:
+                matched = matched[:int(query['limit'][0])]
+            result = [self.project(row, select) for row in matched]
+
+        if single:
+            if len(result) != 1:
+                return 406, {"code": "PGRST116", "message": "JSON object requested, multiple (or no) rows returned",
+                             "details": None, "hint": None}
+            return 200, (result[0], 'application/vnd.pgrst.object+json')
+        return 200, result
+
+
+class FakeLemonSqueezy(FakeHandler):
+    """Products, their variants and checkout creation."""
+
+    def route(self, method, path, query, body):
+        host = self.headers.get('Host')
+        parts = [p for p in path.split('/') if p][1:]
+        if parts[:1] == ['products'] and len(parts) == 2:
+            return 200, {"data": {"type": "products", "id": parts[1], "relationships": {"variants": {
+                "links": {"related": f"http://{host}/v1/products/{parts[1]}/variants"}}}}}
+        if parts[:1] == ['products'] and len(parts) == 3:
+            return 200, {"data": [{"type": "variants", "id": f"{parts[1]}01"}]}
+        if parts == ['checkouts'] and method == 'POST':
+            return 201, {"data": {"type": "checkouts", "id": uuid.uuid4().hex,
+                                  "attributes": {"url": f"https://bench.lemonsqueezy.com/checkout/{uuid.uuid4().hex}"}}}
+        raise KeyError(path)
+
+
+def serve(handler_cls, port, latency, error_rate):
+    handler = type(handler_cls.__name__, (handler_cls,), {"upstream": Upstream(Latency(latency), error_rate)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeUpstreams:
+    """Starts all three fakes on free ports. `env()` gives the variables that point app.py at them."""
+
+    def __init__(self, replicate_latency="fixed:20", prediction_latency="fixed:2000",
+                 supabase_latency="fixed:10", lemon_latency="fixed:50",
+                 replicate_errors=0.0, supabase_errors=0.0, lemon_errors=0.0,
+                 users=100, models_per_user=5):
+        FakeReplicate.prediction_latency = Latency(prediction_latency)
+        FakeSupabase.seed(users, models_per_user)
+        self.replicate = serve(FakeReplicate, 0, replicate_latency, replicate_errors)
+        self.supabase = serve(FakeSupabase, 0, supabase_latency, supabase_errors)
+        self.lemon = serve(FakeLemonSqueezy, 0, lemon_latency, lemon_errors)
+
+    @staticmethod
+    def url(server):
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def env(self):
+        return {
+            "REPLICATE_API_URL": self.url(self.replicate),
+            "REPLICATE_API_TOKEN": "bench",
+            "REPLICATE_POLL_INTERVAL": "0.1",
+            "SUPABASE_URL": self.url(self.supabase),
+            # supabase-py wants something that looks like a jwt
+            "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.bench",
+            "LEMON_SQUEEZY_API_URL": self.url(self.lemon),
+            "LEMON_TEST_SQUEEZY_API_KEY": "bench",
+            "LEMON_SQUEEZY_STORE_ID": "1",
+            "SAMPLE_PRODUCT_ID": "1",
+        }
+
+    def stats(self):
+        return {
+            name: {"requests": server.RequestHandlerClass.upstream.requests,
+                   "errors": server.RequestHandlerClass.upstream.errors}
+            for name, server in (("replicate", self.replicate), ("supabase", self.supabase), ("lemon_squeezy", self.lemon))
+        }
+
+    def shutdown(self):
+        for server in (self.replicate, self.supabase, self.lemon):
+            server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicate-latency', default="fixed:20")
+    parser.add_argument('--prediction-latency', default="fixed:2000", help="how long a prediction takes to finish")
+    parser.add_argument('--supabase-latency', default="fixed:10")
+    parser.add_argument('--lemon-latency', default="fixed:50")
+    parser.add_argument('--replicate-errors', type=float, default=0.0)
+    parser.add_argument('--supabase-errors', type=float, default=0.0)
+    parser.add_argument('--lemon-errors', type=float, default=0.0)
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(args.replicate_latency, args.prediction_latency, args.supabase_latency,
+                              args.lemon_latency, args.replicate_errors, args.supabase_errors, args.lemon_errors)
+    for key, value in upstreams.env().items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        upstreams.shutdown()
+
+
+if __name__ == '__main__':
+    main()
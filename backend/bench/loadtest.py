@@ -0,0 +1,270 @@
+"""Offline load test for app.py.
+
+Starts the fake upstreams from bench/fake_upstreams.py, runs app.py against them in a
+subprocess and drives each scenario at the given concurrency. Reports throughput,
+p50/p95/p99 latency, error counts and the app's peak RSS per scenario, without
+touching Replicate, Supabase or Lemon Squeezy.
+
+    cd backend
+    python -m bench.loadtest --concurrency 16 --requests 200
+    python -m bench.loadtest --scenarios generate --prediction-latency lognormal:8000:0.4 --json out.json
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+import requests
+
+from bench.fake_upstreams import FakeSupabase, FakeUpstreams, TRAINER_VERSION
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JWT_SECRET = "bench-secret"
+SERVE_APP = (
+    "import sys; from app import app; "
+    "app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True, debug=False)"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def access_token(user_id):
+    now = int(time.time())
+    claims = {"sub": user_id, "type": "access", "fresh": False, "jti": f"bench-{user_id}",
+              "iat": now, "nbf": now, "exp": now + 3600}
+    return jwt.encode(claims, JWT_SECRET, algorithm="HS256")
+
+
+def read_peak_rss(pid):
+    """Peak RSS in MB (VmHWM), and reset it so the next scenario starts fresh."""
+    peak = None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+        with open(f"/proc/{pid}/clear_refs", 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass  # not linux, or not allowed to reset. peaks are then cumulative
+    return peak
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def training_zip(images=20, image_bytes=200 * 1024):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for i in range(images):
+            archive.writestr(f"img_{i}.jpg", os.urandom(image_bytes))
+    return buffer.getvalue()
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.upstreams = FakeUpstreams(
+            args.replicate_latency, args.prediction_latency, args.supabase_latency, args.lemon_latency,
+            args.replicate_errors, args.supabase_errors, args.lemon_errors, users=args.users
+        )
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.users = [user['id'] for user in FakeSupabase.tables['users']]
+        self.models_by_user = {}
+        for model in FakeSupabase.tables['models']:
+            self.models_by_user.setdefault(model['user_id'], []).append(model['id'])
+        self.tokens = {user_id: access_token(user_id) for user_id in self.users}
+        self.zip_payload = training_zip()
+        self.training_ids = []
+        self.app = None
+        self._local = threading.local()
+
+    def start_app(self):
+        env = dict(os.environ)
+        env.update(self.upstreams.env())
+        env.update({
+            "JWT_SECRET_KEY": JWT_SECRET,
+            "SECRET_KEY": "bench-flask-secret",
+            # no redis offline, keep sessions on disk
+            "SESSION_TYPE": "filesystem",
+            # measure the app, not the limiter
+            "RATE_LIMIT_GENERATE": "1000000/1",
+            "RATE_LIMIT_TRAINING": "1000000/1",
+            "RATE_LIMIT_BATCH_IMAGES": "1000000/1",
+            "MAX_INFLIGHT_UPSTREAM": "1000",
+            # the bench zip is random bytes, not real images
+            "PREPROCESS_TRAINING_IMAGES": "false",
+            # copying outputs is background work on top of what a request costs, --mirror turns it on
+            "IMAGE_MIRROR_ENABLED": "true" if self.args.mirror else "false",
+        })
+        # without a redis to point at, use a port that refuses right away. The default
+        # address times out, and every redis fallback would then wait REDIS_TIMEOUT
+        env.setdefault("REDIS_URL", "redis://127.0.0.1:1/0")
+        env.pop("SHARED_CACHE_URL", None)
+        env.pop("REPLICATE_WEBHOOK_URL", None)
+        self.app = subprocess.Popen([sys.executable, "-c", SERVE_APP, str(self.port)], cwd=BACKEND_DIR, env=env)
+
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.app.poll() is not None:
+                raise RuntimeError("app.py exited during startup")
+            try:
+                requests.get(self.base_url + "/", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError("app.py did not come up within 60s")
+
+    def stop(self):
+        if self.app is not None:
+            self.app.terminate()
+            self.app.wait(timeout=10)
+        self.upstreams.shutdown()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def headers(self, i):
+        return {"Authorization": f"Bearer {self.tokens[self.users[i % len(self.users)]]}"}
+
+    # -------- scenarios, each does one request --------
+    def scenario_generate(self, i):
+        user_id = self.users[i % len(self.users)]
+        return self.session.post(f"{self.base_url}/generate", headers=self.headers(i), json={
+            "prompt": f"bench prompt {i}", "model_id": self.models_by_user[user_id][0],
+        }, timeout=120)
+
+    def scenario_create_training(self, i):
+        return self.session.post(f"{self.base_url}/create-training", headers=self.headers(i),
+                                 data={"triggerWord": f"bench{i}", "steps": "100"},
+                                 files={"inputImages": ("images.zip", self.zip_payload, "application/zip")},
+                                 timeout=120)
+
+    def scenario_training_processing(self, i):
+        training_id = self.training_ids[i % len(self.training_ids)]
+        return self.session.get(f"{self.base_url}/training_processing/{training_id}",
+                                headers=self.headers(i), timeout=60)
+
+    def scenario_data(self, i):
+        return self.session.get(f"{self.base_url}/data", headers=self.headers(i), timeout=60)
+
+    def prepare_training_processing(self):
+        # a few trainings in flight that every poller shares, like open tabs
+        replicate_url = self.upstreams.url(self.upstreams.replicate)
+        for _ in range(5):
+            response = requests.post(
+                f"{replicate_url}/v1/models/ostris/flux-dev-lora-trainer/versions/{TRAINER_VERSION}/trainings",
+                json={"input": {"trigger_word": "bench"}, "destination": "bench/bench-lora"}, timeout=10)
+            self.training_ids.append(response.json()['id'])
+
+    def run_scenario(self, name):
+        prepare = getattr(self, f"prepare_{name}", None)
+        if prepare:
+            prepare()
+        run_one = getattr(self, f"scenario_{name}")
+        latencies, statuses, failures = [], {}, 0
+        lock = threading.Lock()
+
+        def task(i):
+            nonlocal failures
+            start = time.perf_counter()
+            try:
+                status = run_one(i).status_code
+            except requests.RequestException:
+                status = 'exception'
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 'exception' or status >= 400:
+                    failures += 1
+
+        read_peak_rss(self.app.pid)  # reset the high-water mark
+        upstream_before = self.upstreams.stats()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(task, range(self.args.requests)))
+        wall = time.perf_counter() - start
+        upstream_after = self.upstreams.stats()
+
+        latencies.sort()
+        return {
+            "scenario": name,
+            "requests": len(latencies),
+            "concurrency": self.args.concurrency,
+            "throughput_rps": round(len(latencies) / wall, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "errors": failures,
+            "statuses": {str(k): v for k, v in statuses.items()},
+            "peak_rss_mb": read_peak_rss(self.app.pid),
+            "upstream_requests": {
+                name: upstream_after[name]["requests"] - upstream_before[name]["requests"]
+                for name in upstream_after
+            },
+        }
+
+
+def print_report(results):
+    columns = ("scenario", "requests", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "errors", "peak_rss_mb")
+    print("  ".join(f"{c:>16}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c] if result[c] is not None else '-'):>16}" for c in columns))
+    for result in results:
+        print(f"{result['scenario']}: statuses={result['statuses']} upstream={result['upstream_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default="generate,create_training,training_processing,data")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help="per scenario")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--replicate-latency', default="lognormal:80:0.4")
+    parser.add_argument('--prediction-latency', default="lognormal:2000:0.3")
+    parser.add_argument('--supabase-latency', default="lognormal:20:0.4")
+    parser.add_argument('--lemon-latency', default="lognormal:150:0.4")
+    parser.add_argument('--replicate-errors', type=float, default=0.0)
+    parser.add_argument('--supabase-errors', type=float, default=0.0)
+    parser.add_argument('--lemon-errors', type=float, default=0.0)
+    parser.add_argument('--mirror', action='store_true',
+                        help="mirror generated images (from the fake replicate) like production does")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        bench.start_app()
+        results = [bench.run_scenario(name.strip()) for name in args.scenarios.split(',') if name.strip()]
+    finally:
+        bench.stop()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
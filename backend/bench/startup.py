@@ -0,0 +1,85 @@
+"""Cold start benchmark for app.py.
+
+Two numbers matter when a scale-to-zero fly machine wakes up: how long `import app`
+takes and how long until the first request is answered. This prints both, plus the
+slowest imports from `python -X importtime`:
+
+    cd backend
+    python -m bench.startup --top 25
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from bench.fake_upstreams import FakeUpstreams
+from bench.loadtest import BACKEND_DIR, SERVE_APP, free_port
+
+
+def import_profile(env):
+    """[(cumulative us, self us, module)] from -X importtime, slowest first."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return sorted(rows, reverse=True)
+
+
+def time_to_first_byte(env, path="/ready"):
+    """Seconds from process start until `path` answers."""
+    port = free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", SERVE_APP, str(port)], cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < 60:
+            if proc.poll() is not None:
+                raise RuntimeError("app.py exited during startup")
+            try:
+                requests.get(f"http://127.0.0.1:{port}{path}", timeout=1)
+                return time.perf_counter() - start
+            except requests.RequestException:
+                time.sleep(0.01)
+        raise RuntimeError("app.py did not come up within 60s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=20, help="how many of the slowest imports to show")
+    parser.add_argument('--runs', type=int, default=3, help="time-to-first-byte runs, the best one is reported")
+    args = parser.parse_args()
+
+    # the app needs credentials to import, point it at the local fakes
+    upstreams = FakeUpstreams()
+    env = dict(os.environ)
+    env.update(upstreams.env())
+    # fixed secrets and disk sessions, otherwise startup also waits on redis
+    env.update({"JWT_SECRET_KEY": "bench-secret", "SECRET_KEY": "bench-flask-secret", "SESSION_TYPE": "filesystem"})
+    try:
+        rows = import_profile(env)
+        total = next(cumulative for cumulative, _, module in rows if module.strip() == "app")
+        print(f"import app: {total / 1000:.1f} ms")
+        print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for cumulative, self_us, module in rows[:args.top]:
+            print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {module}")
+
+        ttfb = min(time_to_first_byte(env) for _ in range(args.runs))
+        print(f"\ntime to first byte (/ready): {ttfb * 1000:.0f} ms (best of {args.runs})")
+    finally:
+        upstreams.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from clients import get_redis
+from singleflight import SingleFlight
+
+# redis is optional, the in-process cache works without it
+REDIS_AVAILABLE = importlib.util.find_spec("redis") is not None
+
+# Set this to share cache entries between gunicorn workers / fly machines
+SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL")
+
+_MISSING = object()
+
+# every TTLCache registers itself here so we can report on all of them
+_caches = []
+
+# deletes on a `broadcast` cache are published here so every process (gunicorn workers,
+# celery workers, other machines) drops its local copy too
+INVALIDATION_CHANNEL = "cache:invalidate"
+# prefork servers (celery, gunicorn --preload) import us before forking, so the pid is
+# read per call. The random part tells machines with the same pid apart
+_INSTANCE_ID = uuid.uuid4().hex
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _process_id():
+    return f"{os.getpid()}:{_INSTANCE_ID}"
+
+
+def _key_to_str(key):
+    if isinstance(key, tuple):
+        return ":".join(str(part) for part in key)
+    return str(key)
+
+
+class RedisCache:
+    """Thin cross-process layer over redis, values are stored as JSON."""
+
+    def __init__(self, url, namespace, dumps=json.dumps, loads=json.loads):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("redis package is not installed")
+        self.client = get_redis(url)
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+
+    def redis_key(self, key):
+        return f"{self.namespace}:{_key_to_str(key)}"
+
+    def get(self, key, default=_MISSING):
+        raw = self.client.get(self.redis_key(key))
+        if raw is None:
+            return default
+        return self.loads(raw)
+
+    def get_with_ttl(self, key, default=_MISSING):
+        """(value, seconds left), so a local copy doesn't outlive the redis entry."""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self.redis_key(key))
+        pipe.pttl(self.redis_key(key))
+        raw, pttl = pipe.execute()
+        if raw is None:
+            return default, None
+        return self.loads(raw), (pttl / 1000.0 if pttl and pttl > 0 else None)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.redis_key(key), self.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.redis_key(key))
+
+    def delete_prefix(self, prefix):
+        pattern = f"{self.namespace}:{_key_to_str(prefix)}*"
+        keys = list(self.client.scan_iter(match=pattern))
+        if keys:
+            self.client.delete(*keys)
+
+
+class TTLCache:
+    """Thread safe LRU cache where every entry also expires after a ttl (seconds).
+
+    If a `shared` RedisCache is given, misses fall back to it before calling the
+    loader and writes/invalidations go to both layers. Redis errors never break
+    a request, we just act like it was a miss.
+
+    Concurrent get_or_load misses on the same key share one loader call (across
+    processes too when shared), so upstream calls scale with keys, not callers.
+
+    With `broadcast`, delete / invalidate_prefix also reach the local layer of every
+    other process through redis pub/sub (REDIS_URL).
+    """
+
+    def __init__(self, name, maxsize=256, ttl=300, shared=None, broadcast=False):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.broadcast = broadcast and REDIS_AVAILABLE
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._flight = SingleFlight(name, shared=shared)
+        _caches.append(self)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+        if self.shared is not None:
+            try:
+                value, remaining = self.shared.get_with_ttl(key)
+            except Exception:
+                value = _MISSING
+            if value is not _MISSING:
+                with self._lock:
+                    self.hits += 1
+                self._store(key, value, self._local_ttl(self.ttl, remaining))
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._store(key, value, ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _local_ttl(ttl, remaining):
+        # e.g. a 60s negative entry must not become a cache-wide 24h one locally
+        return ttl if remaining is None else min(ttl, remaining)
+
+    def _store(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None):
+        if self.broadcast:
+            _start_invalidation_listener()
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            def load():
+                loaded = loader()
+                self.set(key, loaded, ttl)
+                return loaded
+            value, _ = self._flight.do(key, load, lambda: self._peek_shared(key, ttl))
+        return value
+
+    def _peek_shared(self, key, ttl=None):
+        """What another process just loaded, without counting it as a hit/miss."""
+        try:
+            value, remaining = self.shared.get_with_ttl(key, None)
+        except Exception:
+            return None
+        if value is not None:
+            self._store(key, value, self._local_ttl(self.ttl if ttl is None else ttl, remaining))
+        return value
+
+    def delete(self, key):
+        self._delete_local(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception:
+                pass
+        self._publish("delete", key)
+
+    def _delete_local(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_prefix(self, *prefix):
+        """Drop every tuple key that starts with `prefix`, e.g. all versions of a model."""
+        self._invalidate_prefix_local(prefix)
+        if self.shared is not None:
+            try:
+                self.shared.delete_prefix(prefix + ("",))
+            except Exception:
+                pass
+        self._publish("prefix", prefix)
+
+    def _invalidate_prefix_local(self, prefix):
+        size = len(prefix)
+        with self._lock:
+            for key in [k for k in self._data if isinstance(k, tuple) and k[:size] == prefix]:
+                del self._data[key]
+
+    def _publish(self, op, key):
+        if not self.broadcast:
+            return
+        message = {"origin": _process_id(), "cache": self.name, "op": op,
+                   "key": list(key) if isinstance(key, tuple) else key, "tuple": isinstance(key, tuple)}
+        try:
+            get_redis().publish(INVALIDATION_CHANNEL, json.dumps(message))
+        except Exception:
+            pass  # the other processes fall back on the ttl
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self._flight.coalesced,
+            }
+
+
+def shared_cache(namespace, **kwargs):
+    """RedisCache for `namespace` when SHARED_CACHE_URL is configured, otherwise None."""
+    if not SHARED_CACHE_URL or not REDIS_AVAILABLE:
+        return None
+    return RedisCache(SHARED_CACHE_URL, namespace, **kwargs)
+
+
+def _apply_invalidation(raw):
+    message = json.loads(raw)
+    if message.get("origin") == _process_id():
+        return  # already applied when we published it
+    key = tuple(message["key"]) if message.get("tuple") else message["key"]
+    for cache in _caches:
+        if cache.broadcast and cache.name == message["cache"]:
+            if message["op"] == "prefix":
+                cache._invalidate_prefix_local(key)
+            else:
+                cache._delete_local(key)
+
+
+def _listen_for_invalidations():
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # anything published while we weren't subscribed is lost, start clean
+            for cache in _caches:
+                if cache.broadcast:
+                    cache.clear()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message and message.get("type") == "message":
+                    _apply_invalidation(message["data"])
+        except Exception:
+            time.sleep(1)
+
+
+def _start_invalidation_listener():
+    """Subscribes on first use rather than at import, cold starts don't wait on redis."""
+    global _listener_pid
+    # a thread started before a fork doesn't exist in the child, each process needs its own
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            _listener_pid = os.getpid()
+            threading.Thread(target=_listen_for_invalidations, name="cache-invalidation", daemon=True).start()
+
+
+def all_cache_stats():
+    return [cache.stats() for cache in _caches]
@@ -0,0 +1,164 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# One shared, keep-alive client per upstream. Every module goes through these getters
+# so connections (and their TCP/TLS handshakes) are reused across requests.
+# The sdk imports happen in the factories, so a cold start only pays for the ones it uses.
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", 10))
+# storage moves whole training zips
+SUPABASE_STORAGE_TIMEOUT = int(os.getenv("SUPABASE_STORAGE_TIMEOUT", 300))
+
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+# base urls can be pointed at local stand-ins, see bench/
+REPLICATE_API_URL = os.getenv("REPLICATE_API_URL", "https://api.replicate.com")
+REPLICATE_TIMEOUT = float(os.getenv("REPLICATE_TIMEOUT", 60))
+REPLICATE_POOL_SIZE = int(os.getenv("REPLICATE_POOL_SIZE", 20))
+
+LEMON_SQUEEZY_API_KEY = os.getenv("LEMON_TEST_SQUEEZY_API_KEY")
+LEMON_SQUEEZY_API_URL = os.getenv("LEMON_SQUEEZY_API_URL", "https://api.lemonsqueezy.com")
+LEMON_SQUEEZY_TIMEOUT = float(os.getenv("LEMON_SQUEEZY_TIMEOUT", 10))
+LEMON_SQUEEZY_POOL_SIZE = int(os.getenv("LEMON_SQUEEZY_POOL_SIZE", 10))
+
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+# read timeout between chunks, not for the whole download
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 30))
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", 10))
+
+# celery broker, sessions and the shared key store all live here
+REDIS_URL = os.getenv("REDIS_URL", 'redis://172.20.116.49:6379/0')
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 20))
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 2))
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _create_supabase(**extra_options):
+    from supabase import create_client
+    try:
+        # the sync client wants these since supabase 2.10, plain ClientOptions lacks fields it reads
+        from supabase.lib.client_options import SyncClientOptions as ClientOptions
+    except ImportError:
+        from supabase.lib.client_options import ClientOptions
+
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Supabase credentials are missing. Please check your .env file.")
+    options = ClientOptions(
+        postgrest_client_timeout=SUPABASE_TIMEOUT,
+        storage_client_timeout=SUPABASE_STORAGE_TIMEOUT,
+        **extra_options
+    )
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+
+
+def _create_replicate():
+    import httpx
+    import replicate
+
+    return replicate.Client(
+        api_token=REPLICATE_API_TOKEN,
+        base_url=REPLICATE_API_URL,
+        timeout=httpx.Timeout(REPLICATE_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=REPLICATE_POOL_SIZE,
+            max_keepalive_connections=REPLICATE_POOL_SIZE
+        )
+    )
+
+
+def _timeout_session(timeout, pool_size, pool_connections=1):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class TimeoutSession(requests.Session):
+        """requests.Session that applies a default timeout to every call."""
+
+        def __init__(self, timeout):
+            super().__init__()
+            self.timeout = timeout
+
+        def request(self, *args, **kwargs):
+            kwargs.setdefault('timeout', self.timeout)
+            return super().request(*args, **kwargs)
+
+    session = TimeoutSession(timeout)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _create_lemon_squeezy():
+    session = _timeout_session((CONNECT_TIMEOUT, LEMON_SQUEEZY_TIMEOUT), LEMON_SQUEEZY_POOL_SIZE)
+    session.headers.update({
+        'Accept': 'application/vnd.api+json',
+        'Authorization': f'Bearer {LEMON_SQUEEZY_API_KEY}'
+    })
+    return session
+
+
+def _create_redis(url):
+    import redis
+
+    # blocks for a free connection (up to REDIS_TIMEOUT) instead of failing when the pool is busy
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT,
+        health_check_interval=30
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def get_redis(url=None):
+    """Pooled redis client, one pool per url (REDIS_URL by default)."""
+    url = url or REDIS_URL
+    return _get_or_create(f'redis:{url}', lambda: _create_redis(url))
+
+
+def get_supabase():
+    return _get_or_create('supabase', _create_supabase)
+
+
+def get_supabase_auth():
+    """For sign in / sign up only. supabase-py switches a client's postgrest auth to the
+    user who just signed in, that must never happen to the client the queries run on."""
+    return _get_or_create('supabase_auth', lambda: _create_supabase(persist_session=False, auto_refresh_token=False))
+
+
+def get_replicate():
+    return _get_or_create('replicate', _create_replicate)
+
+
+def get_lemon_squeezy():
+    return _get_or_create('lemon_squeezy', _create_lemon_squeezy)
+
+
+def get_http():
+    """Plain keep-alive session for file downloads (replicate outputs, signed storage urls)."""
+    return _get_or_create('http', lambda: _timeout_session((CONNECT_TIMEOUT, DOWNLOAD_TIMEOUT), DOWNLOAD_POOL_SIZE,
+                                                            pool_connections=4))
+
+
+def initialized():
+    """Names of the clients built so far, for /ready (no urls, they can hold passwords)."""
+    return sorted({name.split(':', 1)[0] for name in _clients})
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import posixpath
+import re
+import time
+import zipfile
+
+from clients import get_redis
+
+# Training datasets by content: the same images (in any zip, any order of entries) map to
+# the same hash, and the replicate file url uploaded for it the first time is reused by
+# every later training on that hash.
+# replicate file urls don't live forever, keep ours well inside that
+DATASET_STORE_TTL = int(os.getenv("DATASET_STORE_TTL", 20 * 3600))
+HASH_CHUNK_SIZE = 1024 * 1024
+CAPTION_EXTENSIONS = {'txt'}
+DATASET_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def dataset_manifest(src, allowed_extensions):
+    """[{"name", "sha256", "size"}] for every image / caption the trainer would get, by name.
+    Only hashes, nothing is decoded. Raises zipfile.BadZipFile."""
+    manifest = []
+    with zipfile.ZipFile(src) as archive:
+        for info in archive.infolist():
+            name = posixpath.basename(info.filename)
+            ext = _extension(name)
+            if info.is_dir() or not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if ext not in allowed_extensions and ext not in CAPTION_EXTENSIONS:
+                continue
+            digest = hashlib.sha256()
+            with archive.open(info) as entry:
+                for chunk in iter(lambda: entry.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            manifest.append({"name": name, "sha256": digest.hexdigest(), "size": info.file_size})
+    manifest.sort(key=lambda item: (item["name"], item["sha256"]))
+    return manifest
+
+
+def dataset_hash(manifest, settings):
+    """Content address of a dataset. `settings` are whatever changes the processed zip
+    (resolution, preprocessing on/off), so a change there doesn't reuse a stale upload."""
+    raw = json.dumps({"files": [[item["name"], item["sha256"]] for item in manifest], "settings": settings},
+                     sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class DatasetStore:
+    """dataset hash -> {"url", "manifest", "owners", ...} in redis."""
+
+    def __init__(self, prefix="dataset:", ttl=DATASET_STORE_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, digest):
+        raw = get_redis().get(self.prefix + digest)
+        return json.loads(raw) if raw is not None else None
+
+    def get_url(self, digest, user_id):
+        """Stored url for `digest`, if `user_id` has uploaded those images before."""
+        entry = self.get(digest)
+        if entry is None or user_id not in entry.get('owners', []):
+            return None
+        return entry['url']
+
+    def put(self, digest, url, manifest, user_id, expires_at=None):
+        """`expires_at` (epoch seconds) is when replicate drops the file, we forget it an hour before."""
+        ttl = self.ttl
+        if expires_at:
+            ttl = min(ttl, int(expires_at - time.time()) - 3600)
+        if ttl <= 0:
+            return None
+        entry = self.get(digest) or {"url": url, "manifest": manifest, "owners": [], "created_at": time.time()}
+        entry['url'] = url
+        if user_id not in entry['owners']:
+            entry['owners'].append(user_id)
+        get_redis().set(self.prefix + digest, json.dumps(entry), ex=ttl)
+        return entry
+
+    def add_owner(self, digest, user_id):
+        """Someone uploaded the same images, they may reference the hash from now on."""
+        entry = self.get(digest)
+        if entry is None or user_id in entry['owners']:
+            return entry
+        entry['owners'].append(user_id)
+        ttl = get_redis().ttl(self.prefix + digest)
+        if ttl and ttl > 0:
+            get_redis().set(self.prefix + digest, json.dumps(entry), ex=ttl)
+        return entry
+
+
+dataset_store = DatasetStore()
@@ -0,0 +1,232 @@
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import get_http, get_redis
+
+# Generated images are copied off replicate's (expiring) delivery urls into a local mirror,
+# with webp thumbnails, by a small background pool. Ids come from the source url, so the
+# mirror link is known right away and the same output is only ever fetched once per machine.
+# The files are per machine, the id -> source url mapping is in redis, so any instance (or
+# the celery worker) can hand out a link and any other one can serve or redirect it.
+# off: responses carry no mirror links and nothing is copied (e.g. offline benchmarks)
+IMAGE_MIRROR_ENABLED = os.getenv("IMAGE_MIRROR_ENABLED", "true").lower() == "true"
+IMAGE_MIRROR_META_TTL = int(os.getenv("IMAGE_MIRROR_META_TTL", 30 * 24 * 3600))
+IMAGE_MIRROR_DIR = os.getenv("IMAGE_MIRROR_DIR", os.path.join(tempfile.gettempdir(), "image-mirror"))
+THUMBNAIL_SIZES = tuple(int(size) for size in os.getenv("THUMBNAIL_SIZES", "256,512").split(",") if size.strip())
+IMAGE_MIRROR_WORKERS = int(os.getenv("IMAGE_MIRROR_WORKERS", 2))
+IMAGE_MIRROR_MAX_BYTES = int(os.getenv("IMAGE_MIRROR_MAX_BYTES", 32 * 1024 * 1024))
+# the mirror lives on the machine's own disk, past this the least recently served images go
+IMAGE_MIRROR_BUDGET_BYTES = int(os.getenv("IMAGE_MIRROR_BUDGET_BYTES", 256 * 1024 * 1024))
+# prune down to this share of the budget, so we don't walk the dir after every image
+PRUNE_TARGET = 0.8
+THUMBNAIL_QUALITY = 80
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+IMAGE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_MIRROR_WORKERS, thread_name_prefix="image-mirror")
+_pending = set()
+_pending_lock = threading.Lock()
+_prune_lock = threading.Lock()
+_written_since_prune = 0
+
+
+def image_id(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def image_dir(image_id):
+    return os.path.join(IMAGE_MIRROR_DIR, image_id[:2], image_id)
+
+
+def image_path(image_id, size=None):
+    """Mirrored file, the original when `size` is None."""
+    return os.path.join(image_dir(image_id), f"{size}.webp" if size else "original")
+
+
+def mirror_links(url):
+    """Paths the app serves `url` from once it's mirrored (it redirects to `url` until then)."""
+    mirror_id = image_id(url)
+    return {
+        "url": f"/images/{mirror_id}",
+        "thumbnails": {str(size): f"/images/{mirror_id}/{size}" for size in THUMBNAIL_SIZES}
+    }
+
+
+def touch(image_id):
+    """Mark an image as just served, pruning drops the least recently served first."""
+    try:
+        os.utime(image_path(image_id))
+    except OSError:
+        pass
+
+
+def _dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            total += entry.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def prune_mirror(budget=IMAGE_MIRROR_BUDGET_BYTES):
+    """Delete the least recently served images until the mirror is under PRUNE_TARGET of
+    `budget`. Their metadata stays in redis, /images copies them again on demand."""
+    images, total = [], 0
+    try:
+        shards = list(os.scandir(IMAGE_MIRROR_DIR))
+    except FileNotFoundError:
+        return 0
+    for shard in shards:
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            try:
+                size = _dir_size(entry.path)
+                original = os.path.join(entry.path, "original")
+                # one that is still being copied has no original yet, its dir is brand new
+                last_used = os.stat(original if os.path.exists(original) else entry.path).st_mtime
+            except OSError:
+                continue
+            images.append((last_used, size, entry.path))
+            total += size
+    if total <= budget:
+        return 0
+    removed = 0
+    for _, size, path in sorted(images):
+        if total <= budget * PRUNE_TARGET:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def _account_written(nbytes):
+    global _written_since_prune
+    with _prune_lock:
+        _written_since_prune += nbytes
+        if _written_since_prune < IMAGE_MIRROR_BUDGET_BYTES * (1 - PRUNE_TARGET) / 2:
+            return
+        _written_since_prune = 0
+        prune_mirror()
+
+
+def _meta_key(image_id):
+    return f"image_mirror:{image_id}"
+
+
+def read_meta(image_id):
+    """{"source", "content_type", "mirrored"} or None if no instance ever saw this image.
+    `mirrored` is about this machine's copy."""
+    raw = get_redis().get(_meta_key(image_id))
+    if raw is None:
+        return None
+    meta = json.loads(raw)
+    # the original is written last, once it's there the thumbnails are too
+    meta['mirrored'] = os.path.exists(image_path(image_id))
+    return meta
+
+
+def _write_meta(image_id, meta, only_new=False):
+    get_redis().set(_meta_key(image_id), json.dumps(meta), ex=IMAGE_MIRROR_META_TTL, nx=only_new)
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _download(url):
+    with get_http().get(url, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        data = bytearray()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            data.extend(chunk)
+            if len(data) > IMAGE_MIRROR_MAX_BYTES:
+                raise ValueError(f"{url} is bigger than {IMAGE_MIRROR_MAX_BYTES} bytes")
+    return bytes(data), content_type
+
+
+def _render_thumbnail(data, size):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format='WEBP', quality=THUMBNAIL_QUALITY)
+        return out.getvalue()
+
+
+def mirror_image(url):
+    """Download `url` into the mirror and render its thumbnails. Safe to call again."""
+    mirror_id = image_id(url)
+    if os.path.exists(image_path(mirror_id)):
+        return mirror_id
+
+    data, content_type = _download(url)
+    written = len(data)
+    for size in THUMBNAIL_SIZES:
+        thumbnail = _render_thumbnail(data, size)
+        _write_atomic(image_path(mirror_id, size), thumbnail)
+        written += len(thumbnail)
+    _write_meta(mirror_id, {"source": url, "content_type": content_type})
+    _write_atomic(image_path(mirror_id), data)
+    _account_written(written)
+    return mirror_id
+
+
+def _mirror_in_background(url, on_error):
+    try:
+        mirror_image(url)
+    except Exception as e:
+        if on_error:
+            on_error(f"Error mirroring {url}: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending.discard(url)
+
+
+def schedule_mirror(urls, on_error=None, download=True):
+    """Queue `urls` for mirroring on this machine and return their mirror_links. Never
+    blocks on the download. Without `download` only the metadata is written, whichever
+    instance serves the link first makes the copy. With IMAGE_MIRROR_ENABLED off every link
+    is None."""
+    if not IMAGE_MIRROR_ENABLED:
+        return [None] * len(urls)
+    links = []
+    for url in urls:
+        mirror_id = image_id(url)
+        links.append(mirror_links(url))
+        try:
+            # written first so every instance can redirect to the source meanwhile
+            _write_meta(mirror_id, {"source": url}, only_new=True)
+        except Exception as e:
+            if on_error:
+                on_error(f"Error saving mirror metadata for {url}: {str(e)}")
+        if not download or os.path.exists(image_path(mirror_id)):
+            continue
+        with _pending_lock:
+            if url in _pending:
+                continue
+            _pending.add(url)
+        _executor.submit(_mirror_in_background, url, on_error)
+    return links
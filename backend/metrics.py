@@ -0,0 +1,79 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from cache import all_cache_stats
+
+# request latencies go from a few ms (cache hits) to a minute (sync generation)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, float('inf'))
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time spent handling a request, by route',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+UPSTREAM_LATENCY = Histogram(
+    'upstream_call_duration_seconds',
+    'Time spent in outbound calls to supabase / replicate / lemon squeezy',
+    ['upstream', 'operation', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+
+
+@contextmanager
+def upstream_timer(upstream, operation):
+    """with upstream_timer("replicate", "run"): ... records how long the block took."""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(time.perf_counter() - start)
+
+
+def timed_execute(query, operation):
+    """Run a supabase query builder's execute() under upstream_timer."""
+    with upstream_timer('supabase', operation):
+        return query.execute()
+
+
+def observe_request(method, route, status, seconds):
+    REQUEST_LATENCY.labels(method, route, str(status)).observe(seconds)
+
+
+class CacheCollector:
+    """Exposes the TTLCache hit/miss counters next to the latency histograms."""
+
+    def collect(self):
+        hits = CounterMetricFamily('cache_hits', 'Cache hits', labels=['cache'])
+        misses = CounterMetricFamily('cache_misses', 'Cache misses', labels=['cache'])
+        evictions = CounterMetricFamily('cache_evictions', 'Cache evictions', labels=['cache'])
+        coalesced = CounterMetricFamily('cache_coalesced_loads', 'Misses that waited on an in-flight load instead of calling upstream', labels=['cache'])
+        size = GaugeMetricFamily('cache_entries', 'Entries currently cached', labels=['cache'])
+        for stats in all_cache_stats():
+            hits.add_metric([stats['name']], stats['hits'])
+            misses.add_metric([stats['name']], stats['misses'])
+            evictions.add_metric([stats['name']], stats['evictions'])
+            coalesced.add_metric([stats['name']], stats['coalesced'])
+            size.add_metric([stats['name']], stats['size'])
+        return [hits, misses, evictions, coalesced, size]
+
+
+REGISTRY.register(CacheCollector())
+
+
+def render_metrics():
+    """(body, content type) in prometheus text format. With several gunicorn workers set
+    PROMETHEUS_MULTIPROC_DIR so every worker's samples get merged."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
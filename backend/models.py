@@ -1,20 +1,35 @@
-from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.sql import func
-from flask import flash, redirect, url_for
-from supabase import create_client, Client
+from clients import get_supabase, get_supabase_auth
+from metrics import timed_execute, upstream_timer
 import os
+import time
 from dotenv import load_dotenv
+from cache import TTLCache
 
 load_dotenv()
 
 # Remove or comment out the SQLAlchemy initialization
 # db = SQLAlchemy()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-assert SUPABASE_URL is not None and SUPABASE_KEY is not None, "Supabase credentials are missing"
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# all modules share the pooled client from clients.py
+
+# read-through cache for the `models` table. Keys are ("id", model_id), ("user", user_id)
+# and ("name", user_id, name); every write below goes through invalidate_models(), which
+# also reaches the other processes (celery inserts the models that /data lists)
+model_cache = TTLCache(
+    "supabase_models",
+    maxsize=int(os.getenv("MODEL_CACHE_SIZE", 1024)),
+    ttl=int(os.getenv("MODEL_CACHE_TTL", 60)),
+    broadcast=True
+)
+
+# profiles from the `users` table by (id, selected columns). Entries never outlive the jwt that loaded them
+# (see SupabaseUsers.get_profile) and update_user / delete_user drop them
+user_cache = TTLCache(
+    "supabase_users",
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 4096)),
+    ttl=int(os.getenv("USER_CACHE_TTL", 3600)),
+    broadcast=True
+)
 
 # Remove or comment out the Users class
 # class Users(db.Model):
@@ -115,6 +130,23 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 #         return f'<Model {self.name}>'
 
 class SupabaseModels:
+    @staticmethod
+    def invalidate_models(rows=(), model_id=None, user_id=None):
+        """Drop cached lookups touched by a write. `rows` is the write response data."""
+        for row in rows or ():
+            model_cache.delete(("id", row.get("id")))
+            model_cache.invalidate_prefix("user", row.get("user_id"))
+            model_cache.invalidate_prefix("name", row.get("user_id"))
+        if model_id is not None:
+            model_cache.delete(("id", model_id))
+        if user_id is not None:
+            model_cache.invalidate_prefix("user", user_id)
+            model_cache.invalidate_prefix("name", user_id)
+        elif not rows:
+            # don't know whose lists changed, drop all of them
+            model_cache.invalidate_prefix("user")
+            model_cache.invalidate_prefix("name")
+
     @staticmethod
     def insert_model(user_id, name, description, model_version, status):
         data = {
@@ -124,21 +156,35 @@ class SupabaseModels:
             "model_version": model_version,
             "status": status
         }
-        return supabase.table("models").insert(data).execute()
+        response = timed_execute(get_supabase().table("models").insert(data), 'models.insert')
+        SupabaseModels.invalidate_models(response.data, user_id=user_id)
+        return response
+
     @staticmethod
     def get_model_by_id(model_id):
-        response = supabase.table('models').select('*').eq('id', model_id).single().execute()
-        print(f"Supabase response for model_id {model_id}: {response}")  # Add this line for debugging
-        return response
+        return model_cache.get_or_load(
+            ("id", model_id),
+            lambda: timed_execute(get_supabase().table('models').select('*').eq('id', model_id).single(), 'models.get_by_id')
+        )
 
     @staticmethod
     def get_models_by_user_id(user_id):
-        return supabase.table("models").select("*").eq("user_id", user_id).execute()
+        return model_cache.get_or_load(
+            ("user", user_id),
+            lambda: timed_execute(get_supabase().table("models").select("*").eq("user_id", user_id), 'models.get_by_user')
+        )
     
     @staticmethod
     def delete_model_by_id(model_id):
-        return supabase.table('models').delete().eq('id', model_id).execute()
-    
+        response = timed_execute(get_supabase().table('models').delete().eq('id', model_id), 'models.delete')
+        SupabaseModels.invalidate_models(response.data, model_id=model_id)
+        return response
+
+    @staticmethod
+    def delete_models_by_name(name):
+        response = timed_execute(get_supabase().table('models').delete().eq('name', name), 'models.delete_by_name')
+        SupabaseModels.invalidate_models(response.data)
+        return response
 
     # Add other methods as needed
 
@@ -146,42 +192,81 @@ class SupabaseModels:
     # For example:
     @staticmethod
     def update_model(model_id, data):
-        return supabase.table('models').update(data).eq('id', model_id).execute()
+        response = timed_execute(get_supabase().table('models').update(data).eq('id', model_id), 'models.update')
+        SupabaseModels.invalidate_models(response.data, model_id=model_id)
+        return response
+
+    @staticmethod
+    def update_model_by_name(user_id, name, data):
+        response = timed_execute(get_supabase().table('models').update(data).eq('user_id', user_id).eq('name', name), 'models.update_by_name')
+        SupabaseModels.invalidate_models(response.data, user_id=user_id)
+        return response
 
     @staticmethod
-    def get_models_by_name(user_id, name):
-        return supabase.table("models").select("*").eq("user_id", user_id).eq("name", name).execute()
+    def get_models_by_name(user_id, name, fresh=False):
+        """`fresh` skips the cache, for checks that decide whether to write."""
+        load = lambda: timed_execute(get_supabase().table("models").select("*").eq("user_id", user_id).eq("name", name), 'models.get_by_name')
+        if fresh:
+            return load()
+        return model_cache.get_or_load(("name", user_id, name), load)
 
     # Add any other methods you need for your Supabase operations
 
 class SupabaseUsers:
     @staticmethod
     def sign_up_user(email, password, username):
-        user = supabase.auth.sign_up({
-            "email": email,
-            "password": password,
-            "options": {
-                "data": {
-                    "username": username
+        with upstream_timer('supabase', 'auth.sign_up'):
+            user = get_supabase_auth().auth.sign_up({
+                "email": email,
+                "password": password,
+                "options": {
+                    "data": {
+                        "username": username
+                    }
                 }
-            }
-        })
+            })
         return user
 
+    @staticmethod
+    def get_profile(user_id, expires_at=None, fields="id,username"):
+        """`fields` (a postgrest select list) of the user's row in the `users` table, cached per
+        field list. `expires_at` is the jwt's exp claim, the entry is dropped no later than that."""
+        ttl = None
+        if expires_at:
+            ttl = max(0, min(user_cache.ttl, expires_at - time.time()))
+        return user_cache.get_or_load(
+            (str(user_id), fields),
+            lambda: timed_execute(get_supabase().table('users').select(fields).eq('id', user_id).single(), 'users.get').data,
+            ttl=ttl
+        )
+
+    @staticmethod
+    def invalidate_profile(user_id):
+        user_cache.invalidate_prefix(str(user_id))
+
     @staticmethod
     def delete_user(user_id):
         # Note: This requires admin privileges in Supabase
-        return supabase.auth.admin.delete_user(user_id)
+        try:
+            with upstream_timer('supabase', 'auth.delete_user'):
+                return get_supabase().auth.admin.delete_user(user_id)
+        finally:
+            SupabaseUsers.invalidate_profile(user_id)
 
     @staticmethod
     def update_user(user_id, user_data):
         # Note: This requires admin privileges in Supabase
-        return supabase.auth.admin.update_user_by_id(user_id, user_data)
+        try:
+            with upstream_timer('supabase', 'auth.update_user_by_id'):
+                return get_supabase().auth.admin.update_user_by_id(user_id, user_data)
+        finally:
+            SupabaseUsers.invalidate_profile(user_id)
 
     @staticmethod
     def get_user(user_id):
         # Note: This requires admin privileges in Supabase
-        return supabase.auth.admin.get_user_by_id(user_id)
+        with upstream_timer('supabase', 'auth.get_user_by_id'):
+            return get_supabase().auth.admin.get_user_by_id(user_id)
     
     
   
@@ -0,0 +1,148 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import posixpath
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", os.cpu_count() or 1))
+# refuse single entries bigger than this, protects us from zip bombs
+MAX_ENTRY_BYTES = 64 * 1024 * 1024
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+JPEG_QUALITY = 95
+EXIF_ORIENTATION = 0x0112
+# captions next to images are used by the trainer, keep them as they are
+CAPTION_EXTENSIONS = {'txt'}
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def _resize_image(args):
+    """Runs in a pool worker. Returns (name, bytes) or (name, None) if the image is corrupt."""
+    name, data, max_side = args
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        # verify() leaves the image unusable, so open it again for the real work
+        with Image.open(io.BytesIO(data)) as image:
+            # exif_transpose hands back a copy without .format, read both first
+            source_format = image.format
+            rotated = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+            scale = max_side / min(image.size)
+            if not rotated and scale >= 1 and source_format in ('JPEG', 'PNG'):
+                # already small enough, don't recompress
+                return name, data
+
+            image = ImageOps.exif_transpose(image)
+            # the trainer buckets on the short side, so keep that at max_side
+            if scale < 1:
+                size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                image = image.resize(size, Image.LANCZOS)
+
+            out = io.BytesIO()
+            if source_format == 'PNG':
+                # same name, so a caption next to it still pairs up
+                image.save(out, format='PNG', optimize=True)
+            else:
+                image.convert('RGB').save(out, format='JPEG', quality=JPEG_QUALITY)
+                name = name.rsplit('.', 1)[0] + '.jpg'
+            return name, out.getvalue()
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return name, None
+
+
+def _unique_name(name, used):
+    base, ext = posixpath.splitext(name)
+    candidate, i = name, 1
+    while candidate in used:
+        candidate = f"{base}_{i}{ext}"
+        i += 1
+    used.add(candidate)
+    return candidate
+
+
+def _pool(workers):
+    # celery's prefork children are daemonic and can't start processes of their own.
+    # pillow drops the gil while decoding / resizing, so threads still get most of the speedup
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def preprocess_training_zip(src, allowed_extensions, max_side=1024, workers=PREPROCESS_WORKERS):
+    """Clean up a training zip before it goes to replicate.
+
+    Drops entries that aren't allowed images (captions are all kept), byte-identical
+    duplicate images and corrupt images, and downscales the rest so their short side is at
+    most `max_side`. Images are decoded/resized on a process pool (threads inside a
+    daemonic process, e.g. a celery prefork worker) and at most
+    `workers * 2` of them are in flight, so memory stays bounded.
+
+    Returns (spooled zip file rewound to 0, report dict). Raises zipfile.BadZipFile.
+    """
+    report = {"images": 0, "skipped": 0, "duplicates": 0, "corrupt": 0,
+              "bytes_in": 0, "bytes_out": 0}
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, suffix='.zip')
+    seen_hashes = set()
+    used_names = set()
+
+    try:
+        with zipfile.ZipFile(src) as archive, \
+                zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as result, \
+                _pool(max(1, workers)) as pool:
+
+            def write_done(futures):
+                for future in futures:
+                    name, data = future.result()
+                    if data is None:
+                        report["corrupt"] += 1
+                        continue
+                    result.writestr(_unique_name(name, used_names), data)
+                    report["images"] += 1
+                    report["bytes_out"] += len(data)
+
+            pending = []
+            for info in archive.infolist():
+                name = posixpath.basename(info.filename)
+                ext = _extension(name)
+                if info.is_dir() or not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                    continue
+                if ext not in allowed_extensions and ext not in CAPTION_EXTENSIONS:
+                    report["skipped"] += 1
+                    continue
+                if info.file_size > MAX_ENTRY_BYTES:
+                    report["skipped"] += 1
+                    continue
+
+                data = archive.read(info)
+                report["bytes_in"] += len(data)
+                if ext in CAPTION_EXTENSIONS:
+                    # never deduped, identical captions ("a photo of TOK") belong to different images
+                    result.writestr(_unique_name(name, used_names), data)
+                    report["bytes_out"] += len(data)
+                    continue
+
+                digest = hashlib.sha256(data).digest()
+                if digest in seen_hashes:
+                    report["duplicates"] += 1
+                    continue
+                seen_hashes.add(digest)
+
+                pending.append(pool.submit(_resize_image, (name, data, max_side)))
+                if len(pending) >= workers * 2:
+                    write_done(pending)
+                    pending = []
+
+            write_done(pending)
+    except Exception:
+        out.close()
+        raise
+
+    out.seek(0)
+    return out, report
@@ -0,0 +1,153 @@
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+from cache import TTLCache, RedisCache, REDIS_AVAILABLE, SHARED_CACHE_URL
+from clients import REDIS_URL
+
+# Atomic token bucket: refill by elapsed time, then try to take `cost` tokens.
+# Returns {allowed, seconds until enough tokens are back}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+# buckets are in redis even without SHARED_CACHE_URL, a per process limit multiplies with
+# every gunicorn worker and machine
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL") or SHARED_CACHE_URL or REDIS_URL
+# after a redis error use the local buckets for a bit instead of waiting on it every request
+RATE_LIMIT_REDIS_BACKOFF = 30
+
+
+def parse_rate(value):
+    """"10/60" -> 10 requests per 60 seconds, which is also the burst size."""
+    count, seconds = value.split('/')
+    return int(count), float(seconds)
+
+
+class TokenBucketLimiter:
+    """Per key token buckets in redis (RATE_LIMIT_REDIS_URL) so the limit holds across
+    workers and machines. Per process only while redis is unreachable."""
+
+    def __init__(self, namespace="ratelimit", url=RATE_LIMIT_REDIS_URL):
+        self.namespace = namespace
+        self.shared = RedisCache(url, namespace) if url and REDIS_AVAILABLE else None
+        self._script = self.shared.client.register_script(TOKEN_BUCKET_SCRIPT) if self.shared else None
+        self._local = TTLCache("ratelimit_buckets", maxsize=10000, ttl=3600)
+        self._lock = threading.Lock()
+        self._redis_down_until = 0
+
+    def take(self, key, count, seconds, cost=1):
+        """Returns (allowed, retry_after_seconds)."""
+        rate = count / seconds
+        now = time.time()
+        if self._script is not None and now >= self._redis_down_until:
+            try:
+                allowed, retry_after = self._script(keys=[f"{self.namespace}:{key}"], args=[rate, count, now, cost])
+                return bool(int(allowed)), float(retry_after)
+            except Exception:
+                # redis is unavailable, fall back to this process' buckets
+                self._redis_down_until = now + RATE_LIMIT_REDIS_BACKOFF
+
+        with self._lock:
+            tokens, ts = self._local.get(key) or (count, now)
+            tokens = min(count, tokens + max(0, now - ts) * rate)
+            if tokens >= cost:
+                self._local.set(key, (tokens - cost, now))
+                return True, 0
+            self._local.set(key, (tokens, now))
+            return False, (cost - tokens) / rate
+
+
+limiter = TokenBucketLimiter()
+
+# how many slow upstream calls (generation / training) one process runs at once, for every
+# user combined. Beyond this we shed load right away instead of queueing on worker threads
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT_UPSTREAM", 8))
+INFLIGHT_RETRY_AFTER = 5
+_inflight = threading.BoundedSemaphore(MAX_INFLIGHT)
+
+
+def too_many_requests(message, retry_after):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def acquire_inflight(slots=1):
+    """Take `slots` of the in-flight cap without waiting, all or none."""
+    taken = 0
+    while taken < slots:
+        if not _inflight.acquire(blocking=False):
+            for _ in range(taken):
+                _inflight.release()
+            return False
+        taken += 1
+    return True
+
+
+def release_inflight(slots=1):
+    for _ in range(slots):
+        _inflight.release()
+
+
+def check_rate_limit(route, limit, cost=1):
+    """None if the caller may spend `cost` tokens of `route`'s bucket, else the 429 to send.
+    For views that only know their cost after reading the body (see /generate/batch)."""
+    count, seconds = parse_rate(limit)
+    if cost > count:
+        return too_many_requests(f"Request needs {cost} requests of a {limit} limit", math.ceil(seconds))
+    allowed, retry_after = limiter.take(f"{route}:{get_jwt_identity()}", count, seconds, cost)
+    if not allowed:
+        return too_many_requests("Rate limit exceeded", max(1, math.ceil(retry_after)))
+    return None
+
+
+def rate_limited(route, limit, shed_load=True):
+    """Token bucket per (route, jwt identity) with `limit` like "10/60", plus the shared
+    in-flight cap when `shed_load` is set. Goes under @jwt_required()."""
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == 'OPTIONS':
+                return f(*args, **kwargs)
+
+            limited = check_rate_limit(route, limit)
+            if limited is not None:
+                return limited
+
+            if not shed_load:
+                return f(*args, **kwargs)
+            if not acquire_inflight():
+                return too_many_requests("Server is busy, try again shortly", INFLIGHT_RETRY_AFTER)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                release_inflight()
+        return decorated_function
+    return decorator
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import time
+
+from cache import TTLCache, shared_cache
+from singleflight import SingleFlight
+
+# replicate deletes api prediction outputs after an hour, so cached urls must die before that
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 50 * 60))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 5000))
+# longest we expect a single prediction to take, bounds how long others wait on it
+INFLIGHT_TIMEOUT = int(os.getenv("RESULT_INFLIGHT_TIMEOUT", 180))
+INFLIGHT_POLL_INTERVAL = 0.5
+
+
+def _normalise(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, float):
+        return round(value, 4)
+    return value
+
+
+def generation_key(model_name, model_version, generation_input):
+    """Content address of a generation: same model, version and normalised inputs -> same key."""
+    normalised = {k: _normalise(v) for k, v in generation_input.items()}
+    raw = json.dumps([model_name, model_version, normalised], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Generation results by content address, plus coalescing of identical in-flight requests.
+
+    With redis (SHARED_CACHE_URL) results are shared by every worker, entries expire after
+    RESULT_CACHE_TTL and an index sorted by insert time trims the oldest ones beyond
+    RESULT_CACHE_MAX_ENTRIES. Identical in-flight requests share one prediction through
+    SingleFlight, on other processes too (they wait on a redis lock, then read the result).
+    """
+
+    def __init__(self, namespace="results", ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared_cache(namespace)
+        self.local = TTLCache("generation_results", maxsize=min(max_entries, 1024), ttl=ttl)
+        self._flight = SingleFlight("generation_results", shared=self.shared,
+                                    timeout=INFLIGHT_TIMEOUT, poll_interval=INFLIGHT_POLL_INTERVAL)
+
+    @property
+    def _index_key(self):
+        return f"{self.namespace}:index"
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value, remaining = self.shared.get_with_ttl(key, None)
+            except Exception:
+                value = None
+            if value is not None:
+                # only what's left in redis, a copy made late must not outlive replicate's files
+                self.local.set(key, value, TTLCache._local_ttl(self.ttl, remaining))
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is None:
+            return
+        try:
+            self.shared.set(key, value, self.ttl)
+            client = self.shared.client
+            now = time.time()
+            pipe = client.pipeline()
+            pipe.zadd(self._index_key, {key: now})
+            # age: drop index entries whose keys already expired
+            pipe.zremrangebyscore(self._index_key, 0, now - self.ttl)
+            pipe.zcard(self._index_key)
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                # size: evict the oldest entries
+                oldest = client.zrange(self._index_key, 0, size - self.max_entries - 1)
+                if oldest:
+                    client.delete(*[self.shared.redis_key(k.decode('utf-8')) for k in oldest])
+                    client.zrem(self._index_key, *oldest)
+        except Exception:
+            pass
+
+    def get_or_run(self, key, run):
+        """Returns (result, cached). Concurrent callers with the same key share one `run()`."""
+        value = self.get(key)
+        if value is not None:
+            return value, True
+
+        def run_and_store():
+            result = run()
+            self.set(key, result)
+            return result
+
+        return self._flight.do(key, run_and_store, lambda: self.get(key))
+
+
+result_cache = ResultCache()
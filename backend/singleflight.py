@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+# cross-process coalescing takes a short redis lock per miss, can be turned off
+SINGLEFLIGHT_REDIS_LOCKS = os.getenv("SINGLEFLIGHT_REDIS_LOCKS", "true").lower() == "true"
+SINGLEFLIGHT_TIMEOUT = int(os.getenv("SINGLEFLIGHT_TIMEOUT", 30))
+SINGLEFLIGHT_POLL_INTERVAL = 0.05
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight call and its result.
+
+    Within a process the first caller (the leader) runs `fn` and everyone else waits on
+    its Future. With `shared` (a cache.RedisCache) and a `recheck` callable, callers on
+    other processes also line up behind a redis lock: they wait for the leader to finish
+    and then `recheck()` (e.g. read the shared cache the leader just filled) instead of
+    calling the upstream themselves. `recheck()` returning None means "not there, run it".
+    """
+
+    def __init__(self, name, shared=None, timeout=SINGLEFLIGHT_TIMEOUT, poll_interval=SINGLEFLIGHT_POLL_INTERVAL):
+        self.name = name
+        self.shared = shared if SINGLEFLIGHT_REDIS_LOCKS else None
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.coalesced = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lock_key(self, key):
+        return self.shared.redis_key(("lock", key))
+
+    def do(self, key, fn, recheck=None):
+        """Returns (result, shared), `shared` is True when another call produced the result."""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(timeout=self.timeout), True
+
+        try:
+            value, shared = self._run_across_processes(key, fn, recheck)
+            future.set_result(value)
+            return value, shared
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _run_across_processes(self, key, fn, recheck):
+        if self.shared is None or recheck is None:
+            return fn(), False
+
+        client = self.shared.client
+        lock_key = self._lock_key(key)
+        try:
+            acquired = client.set(lock_key, "1", nx=True, ex=self.timeout)
+        except Exception:
+            acquired = True  # redis is down, just do the work
+
+        if not acquired:
+            # another process is already on it, wait for its result
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                value = recheck()
+                if value is not None:
+                    with self._lock:
+                        self.coalesced += 1
+                    return value, True
+                try:
+                    if not client.exists(lock_key):
+                        break  # it failed or died, we'll run it ourselves
+                except Exception:
+                    break
+
+        try:
+            return fn(), False
+        finally:
+            if acquired:
+                try:
+                    client.delete(lock_key)
+                except Exception:
+                    pass
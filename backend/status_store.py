@@ -0,0 +1,97 @@
+import os
+import time
+
+from cache import TTLCache, RedisCache, REDIS_AVAILABLE, SHARED_CACHE_URL
+from clients import REDIS_URL
+
+TERMINAL_STATUSES = {'succeeded', 'failed', 'canceled'}
+# entries outlive the longest trainings by a good margin
+STATUS_STORE_TTL = int(os.getenv("STATUS_STORE_TTL", 24 * 3600))
+# a webhook lands on one worker of one machine, everyone else has to see it
+STATUS_STORE_REDIS_URL = SHARED_CACHE_URL or REDIS_URL
+
+# fields we keep from replicate training / prediction objects and webhook payloads
+SNAPSHOT_FIELDS = ('id', 'status', 'created_at', 'started_at', 'completed_at',
+                   'input', 'output', 'logs', 'error', 'urls')
+
+
+def snapshot(obj):
+    """Plain dict of a replicate Training/Prediction (or a webhook payload)."""
+    if isinstance(obj, dict):
+        data = {field: obj.get(field) for field in SNAPSHOT_FIELDS}
+    else:
+        data = {field: getattr(obj, field, None) for field in SNAPSHOT_FIELDS}
+    for field in ('created_at', 'started_at', 'completed_at'):
+        if data[field] is not None and not isinstance(data[field], str):
+            data[field] = data[field].isoformat()
+    if data['urls'] is not None and not isinstance(data['urls'], dict):
+        data['urls'] = dict(data['urls'])
+    return data
+
+
+class StatusStore:
+    """Last known state of replicate trainings/predictions, fed by webhooks.
+
+    Lives in redis (SHARED_CACHE_URL, else REDIS_URL) so every worker/machine sees the
+    same webhook updates. Per-process only when the redis package is missing.
+    """
+
+    def __init__(self, kind, ttl=STATUS_STORE_TTL, url=STATUS_STORE_REDIS_URL):
+        self.kind = kind
+        self.ttl = ttl
+        self.shared = RedisCache(url, f"status:{kind}") if url and REDIS_AVAILABLE else None
+        self.local = None if self.shared else TTLCache(f"status_{kind}", maxsize=1024, ttl=ttl)
+
+    def get(self, object_id):
+        if self.shared is not None:
+            try:
+                return self.shared.get(object_id, None)
+            except Exception:
+                return None
+        return self.local.get(object_id)
+
+    def put(self, data, **extra):
+        """Store a snapshot. A terminal state is never overwritten by a late, older event."""
+        current = self.get(data['id'])
+        if current and current.get('status') in TERMINAL_STATUSES \
+                and data.get('status') not in TERMINAL_STATUSES:
+            return current
+
+        entry = dict(current or {})
+        entry.update(data)
+        entry.update(extra)
+        entry['stored_at'] = time.time()
+
+        if self.shared is not None:
+            try:
+                self.shared.set(data['id'], entry, self.ttl)
+            except Exception:
+                pass
+        else:
+            self.local.set(data['id'], entry)
+        return entry
+
+    def update(self, object_id, **fields):
+        entry = self.get(object_id)
+        if entry is not None:
+            entry.update(fields)
+            if self.shared is not None:
+                try:
+                    self.shared.set(object_id, entry, self.ttl)
+                except Exception:
+                    pass
+            else:
+                self.local.set(object_id, entry)
+        return entry
+
+    @staticmethod
+    def is_fresh(entry, max_age):
+        if entry is None:
+            return False
+        if entry.get('status') in TERMINAL_STATUSES:
+            return True
+        return time.time() - entry.get('stored_at', 0) < max_age
+
+
+training_store = StatusStore("trainings")
+prediction_store = StatusStore("predictions")
@@ -0,0 +1,39 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# in-memory broker / backend and a fake redis, so the tests run without any services
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "test-key")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("JWT_SECRET_KEY", "test-jwt-secret-that-is-long-enough-for-hs256")
+os.environ["CELERY_BROKER_URL"] = "memory://"
+os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+
+import clients  # noqa: E402
+
+clients._clients[f"redis:{clients.REDIS_URL}"] = fakeredis.FakeRedis()
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    model = SimpleNamespace(data={"id": 1, "name": "someone/model", "model_version": "abc123"})
+    monkeypatch.setattr(app_module.SupabaseModels, "get_model_by_id", staticmethod(lambda model_id: model))
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def auth_headers():
+    def headers(user_id):
+        with app_module.app.app_context():
+            return {"Authorization": f"Bearer {create_access_token(identity=user_id)}"}
+    return headers
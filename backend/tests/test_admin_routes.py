@@ -0,0 +1,13 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize("path", ["/allusers", "/allusers?format=ndjson", "/recent-predictions"])
+def test_account_wide_routes_are_admin_only(client, auth_headers, monkeypatch, path):
+    monkeypatch.setattr(app_module, "ADMIN_USER_IDS", {"admin"})
+    monkeypatch.setattr(app_module, "fetch_users_page", lambda fields, limit, after: [{"id": "u1"}])
+    monkeypatch.setattr(app_module, "get_recent_predictions", lambda limit, cursor: {"predictions": []})
+
+    assert client.get(path, headers=auth_headers("someone")).status_code == 403
+    assert client.get(path, headers=auth_headers("admin")).status_code == 200
@@ -0,0 +1,12 @@
+def test_async_generate_enqueues_a_job(client, auth_headers):
+    response = client.post("/generate", json={"prompt": "a cat", "model_id": 1, "async": True},
+                           headers=auth_headers("user-1"))
+    assert response.status_code == 202, response.get_json()
+    job_id = response.get_json()["job_id"]
+
+    status = client.get(f"/generate/{job_id}", headers=auth_headers("user-1"))
+    assert status.status_code == 200
+    assert status.get_json()["status"] == "queued"
+
+    # nobody else gets to see it
+    assert client.get(f"/generate/{job_id}", headers=auth_headers("user-2")).status_code == 404
@@ -0,0 +1,23 @@
+import os
+
+import image_mirror
+
+
+def add_image(image_id, size, mtime):
+    os.makedirs(image_mirror.image_dir(image_id), exist_ok=True)
+    with open(image_mirror.image_path(image_id), 'wb') as original:
+        original.write(b"x" * size)
+    os.utime(image_mirror.image_path(image_id), (mtime, mtime))
+
+
+def test_prune_drops_least_recently_served_first(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_mirror, "IMAGE_MIRROR_DIR", str(tmp_path))
+    add_image("a" * 32, 400, 1000)
+    add_image("b" * 32, 400, 3000)
+    add_image("c" * 32, 400, 2000)
+
+    assert image_mirror.prune_mirror(budget=2000) == 0
+    assert image_mirror.prune_mirror(budget=900) == 2
+    assert os.path.exists(image_mirror.image_path("b" * 32))
+    assert not os.path.exists(image_mirror.image_dir("a" * 32))
+    assert not os.path.exists(image_mirror.image_dir("c" * 32))
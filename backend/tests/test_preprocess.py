@@ -0,0 +1,44 @@
+import io
+import zipfile
+
+from PIL import Image
+
+from preprocess import preprocess_training_zip
+
+
+def image_bytes(size, fmt, exif=None):
+    out = io.BytesIO()
+    Image.new('RGB', size, (200, 40, 40)).save(out, format=fmt, **({"exif": exif} if exif else {}))
+    return out.getvalue()
+
+
+def run(entries, max_side=1024):
+    src = io.BytesIO()
+    with zipfile.ZipFile(src, 'w') as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    src.seek(0)
+    out, report = preprocess_training_zip(src, {'png', 'jpg', 'jpeg'}, max_side=max_side, workers=1)
+    with zipfile.ZipFile(out) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}, report
+
+
+def test_small_images_are_kept_as_they_are():
+    png, jpg = image_bytes((300, 200), 'PNG'), image_bytes((300, 200), 'JPEG')
+    files, _ = run({"x.png": png, "x.jpg": jpg, "x.txt": b"a photo of TOK"})
+    assert files == {"x.png": png, "x.jpg": jpg, "x.txt": b"a photo of TOK"}
+
+
+def test_large_png_is_resized_under_the_same_name():
+    files, _ = run({"big.png": image_bytes((600, 400), 'PNG'), "big.txt": b"caption"}, max_side=200)
+    assert set(files) == {"big.png", "big.txt"}
+    with Image.open(io.BytesIO(files["big.png"])) as image:
+        assert image.format == 'PNG' and min(image.size) == 200
+
+
+def test_exif_rotation_is_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90
+    files, _ = run({"r.jpg": image_bytes((300, 200), 'JPEG', exif=exif)})
+    with Image.open(io.BytesIO(files["r.jpg"])) as image:
+        assert image.size == (200, 300)
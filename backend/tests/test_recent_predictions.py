@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import app as app_module
+import image_mirror
+
+
+class FakePredictions:
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = []
+
+    def list(self, cursor=None):
+        self.fetched.append(cursor)
+        results, next_cursor = self.pages[cursor]
+        return SimpleNamespace(results=results, next=next_cursor)
+
+
+def prediction(i):
+    return SimpleNamespace(status="succeeded", output=[f"https://example.invalid/{i}.webp"],
+                           input={"prompt": f"prompt {i}"})
+
+
+def test_a_full_first_page_does_not_fetch_the_next(monkeypatch):
+    predictions = FakePredictions({None: ([prediction(i) for i in range(20)], "1"),
+                                   "1": ([prediction(i) for i in range(20, 40)], None)})
+    monkeypatch.setattr(app_module, "get_replicate", lambda: SimpleNamespace(predictions=predictions))
+    monkeypatch.setattr(image_mirror, "IMAGE_MIRROR_ENABLED", False)
+    app_module.recent_predictions_cache.clear()
+
+    first = app_module.get_recent_predictions(limit=20)
+    assert len(first["predictions"]) == 20
+    assert predictions.fetched == [None]
+
+    second = app_module.get_recent_predictions(limit=20, cursor=first["next_cursor"])
+    assert [p["prompt"] for p in second["predictions"]] == [f"prompt {i}" for i in range(20, 40)]
+    assert second["next_cursor"] is None
+    assert predictions.fetched == [None, "1"]
@@ -0,0 +1,38 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import app as app_module
+from status_store import training_store
+
+SECRET = "whsec_" + base64.b64encode(b"test-webhook-signing-key").decode()
+
+
+def signed_headers(body, webhook_id="msg_1", timestamp=None, secret=SECRET):
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    key = base64.b64decode(secret.split('_', 1)[1])
+    signature = base64.b64encode(
+        hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()).decode()
+    return {"webhook-id": webhook_id, "webhook-timestamp": timestamp, "webhook-signature": f"v1,{signature}",
+            "Content-Type": "application/json"}
+
+
+def test_signed_webhook_updates_the_status_store(client, monkeypatch):
+    monkeypatch.setattr(app_module, "REPLICATE_WEBHOOK_SECRET", SECRET)
+    body = json.dumps({"id": "tr_1", "status": "processing", "destination": "someone/model"}).encode()
+    response = client.post("/webhook?kind=training", data=body, headers=signed_headers(body))
+    assert response.status_code == 200
+    assert training_store.get("tr_1")["status"] == "processing"
+
+
+def test_webhook_rejects_bad_or_old_signatures(client, monkeypatch):
+    monkeypatch.setattr(app_module, "REPLICATE_WEBHOOK_SECRET", SECRET)
+    body = json.dumps({"id": "tr_2", "status": "succeeded"}).encode()
+    other_secret = "whsec_" + base64.b64encode(b"someone-else").decode()
+    assert client.post("/webhook", data=body, headers=signed_headers(body, secret=other_secret)).status_code == 400
+    old = signed_headers(body, timestamp=int(time.time()) - 3600)
+    assert client.post("/webhook", data=body, headers=old).status_code == 400
+    assert client.post("/webhook", data=body, headers={"Content-Type": "application/json"}).status_code == 400
+    assert training_store.get("tr_2") is None
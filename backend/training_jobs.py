@@ -0,0 +1,125 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from clients import get_http, get_redis, get_supabase
+from metrics import upstream_timer
+
+# /create-training only saves the upload and queues a job, the celery chain in app.py
+# does the replicate / supabase calls. Job state lives in redis (the celery broker) so
+# the web process and the workers see the same thing.
+TRAINING_JOB_TTL = int(os.getenv("TRAINING_JOB_TTL", 24 * 3600))
+# datasets go to supabase storage, workers may run on other machines than the upload.
+# The bucket has to exist (private)
+TRAINING_DATASET_BUCKET = os.getenv("TRAINING_DATASET_BUCKET", "training-datasets")
+# local copies, a step that runs where the file already is skips the download
+TRAINING_DATASET_DIR = os.getenv("TRAINING_DATASET_DIR", os.path.join(tempfile.gettempdir(), "training-datasets"))
+COPY_CHUNK_SIZE = 1024 * 1024
+SIGNED_URL_SECONDS = 600
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def dataset_path(job_id, version='raw'):
+    """Local copy of a job's dataset. `version` is 'raw' (the upload) or 'processed'."""
+    return os.path.join(TRAINING_DATASET_DIR, f"{job_id}.{version}.zip")
+
+
+def _storage_path(job_id, version):
+    return f"{job_id}/{version}.zip"
+
+
+def _write_local(path, src):
+    # temp name first, so nobody ever sees half a zip
+    os.makedirs(TRAINING_DATASET_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=TRAINING_DATASET_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            if isinstance(src, bytes):
+                out.write(src)
+            else:
+                shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_dataset(job_id, src, version='raw'):
+    """Copy an open file to the bucket (and keep a local copy). Returns the local path."""
+    path = dataset_path(job_id, version)
+    _write_local(path, src)
+    # an open file, storage3 never closes the ones it opens from a path
+    with open(path, 'rb') as dataset, upstream_timer('supabase', 'storage.upload'):
+        get_supabase().storage.from_(TRAINING_DATASET_BUCKET).upload(
+            _storage_path(job_id, version), dataset, {"content-type": "application/zip", "upsert": "true"}
+        )
+    return path
+
+
+def fetch_dataset(job_id, version='raw'):
+    """Local path of the dataset, downloaded from the bucket unless it's already here."""
+    path = dataset_path(job_id, version)
+    if os.path.exists(path):
+        return path
+    with upstream_timer('supabase', 'storage.download'):
+        signed = get_supabase().storage.from_(TRAINING_DATASET_BUCKET).create_signed_url(
+            _storage_path(job_id, version), SIGNED_URL_SECONDS
+        )
+        url = signed.get('signedURL') or signed.get('signedUrl')
+        with get_http().get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            _write_local(path, response.raw)
+    return path
+
+
+def delete_dataset(job_id):
+    for path in glob.glob(os.path.join(TRAINING_DATASET_DIR, f"{job_id}.*.zip")):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    try:
+        get_supabase().storage.from_(TRAINING_DATASET_BUCKET).remove(
+            [_storage_path(job_id, version) for version in ('raw', 'processed')]
+        )
+    except Exception:
+        pass  # a leftover object is only storage, not worth failing a job over
+
+
+class TrainingJobStore:
+    """One json blob per job. Only the chain's current step writes to a job, so a plain
+    read-modify-write is enough."""
+
+    def __init__(self, prefix="training_job:", ttl=TRAINING_JOB_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def create(self, job_id, **fields):
+        now = time.time()
+        job = dict(fields, id=job_id, status='queued', created_at=now, updated_at=now)
+        get_redis().set(self.prefix + job_id, json.dumps(job), ex=self.ttl, nx=True)
+        return job
+
+    def get(self, job_id):
+        raw = get_redis().get(self.prefix + job_id)
+        return json.loads(raw) if raw is not None else None
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(f"Training job {job_id} not found")
+        job.update(fields)
+        job['updated_at'] = time.time()
+        get_redis().set(self.prefix + job_id, json.dumps(job), ex=self.ttl)
+        return job
+
+
+training_jobs = TrainingJobStore()